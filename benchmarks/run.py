@@ -0,0 +1,251 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from benchmarks.seed import generate_image, seed
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import sys
+import threading
+import time
+
+# Explanation of the benchmarks:
+# - A database is seeded with synthetic days of images (see benchmarks/seed.py), either in memory through mongomock
+#   or in the mongod given by --mongo-uri
+# - The app is served by waitress in this process, like the production server, and every scenario sends its requests
+#   over HTTP from --concurrency threads
+# - Each scenario reports its throughput and p50/p99 latency, the peak RSS of the process is reported at the end
+# - Results are compared with a saved baseline (benchmarks/baseline.json) run with the same arguments, a scenario whose
+#   p99 latency or throughput is worse by more than --tolerance fails the run
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# Database seeded and served by the benchmarks, the only one they drop
+BENCH_DATABASE = "imaginate_bench"
+
+# Arguments that change what is measured, runs are only compared with a baseline of the same arguments
+COMPARED_ARGUMENTS = ["days", "images", "requests", "concurrency", "seed", "mongo_uri"]
+
+
+# Scenarios as name -> function building (method, path, request options) from the seeded data
+def get_scenarios(days: int, ids: list, uploads: list):
+  def upload(rng):
+    files = {"file": ("upload.jpg", rng.choice(uploads), "image/jpeg")}
+    data = {"date": rng.randrange(days), "theme": "benchmark", "real": "true"}
+    return "POST", "/image/create", {"files": files, "data": data}
+
+  return {
+    "date_images": lambda rng: ("GET", f"/date/{rng.randrange(days)}/images", {}),
+    "date_images_manifest": lambda rng: (
+      "GET",
+      f"/date/{rng.randrange(days)}/images?format=manifest",
+      {},
+    ),
+    "date_latest": lambda rng: ("GET", "/date/latest", {}),
+    "image_read": lambda rng: ("GET", f"/image/read/{rng.choice(ids)}", {}),
+    "image_read_rendition": lambda rng: (
+      "GET",
+      f"/image/read/{rng.choice(ids)}?size=320",
+      {},
+    ),
+    "image_list": lambda rng: ("GET", "/image/read?limit=50", {}),
+    "image_all_images": lambda rng: ("GET", "/image/all-images?limit=50", {}),
+    "image_create": upload,
+  }
+
+
+# Helper function to get a percentile of sorted latencies
+def get_percentile(latencies: list[float], percentile: float):
+  index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+  return latencies[index]
+
+
+# Send a scenario's requests from concurrent threads, returning its results
+def run_scenario(
+  base_url: str, build_request, requests_count: int, concurrency: int, seed_value: int
+):
+  # Imported here so that running with --help does not need the app's dependencies
+  import requests
+
+  local = threading.local()
+
+  def send(index: int):
+    if not hasattr(local, "session"):
+      local.session = requests.Session()
+    method, path, options = build_request(random.Random(seed_value + index))
+    start = time.perf_counter()
+    response = local.session.request(method, base_url + path, **options)
+    response.content  # Read the whole body
+    return time.perf_counter() - start, response.status_code
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(concurrency) as executor:
+    results = list(executor.map(send, range(requests_count)))
+  elapsed = time.perf_counter() - start
+
+  latencies = sorted(latency for latency, _ in results)
+  return {
+    "requests": requests_count,
+    "errors": sum(status >= 400 for _, status in results),
+    "rps": round(requests_count / elapsed, 1),
+    "p50_ms": round(get_percentile(latencies, 50) * 1000, 2),
+    "p99_ms": round(get_percentile(latencies, 99) * 1000, 2),
+    "mean_ms": round(statistics.fmean(latencies) * 1000, 2),
+  }
+
+
+# Compare results with a baseline, returning the regressions found
+def compare(results: dict, baseline: dict, tolerance: float):
+  regressions = []
+  for name, result in results.items():
+    expected = baseline.get(name)
+    if expected is None:
+      continue
+    if result["p99_ms"] > expected["p99_ms"] * (1 + tolerance):
+      regressions.append(
+        f"{name}: p99 {expected['p99_ms']} ms -> {result['p99_ms']} ms"
+      )
+    if result["rps"] < expected["rps"] * (1 - tolerance):
+      regressions.append(f"{name}: {expected['rps']} req/s -> {result['rps']} req/s")
+  return regressions
+
+
+# Helper function to drop the benchmark database before seeding it, refusing to drop any other database
+def drop_bench_database(client, name: str = BENCH_DATABASE):
+  if name != BENCH_DATABASE:
+    raise ValueError(f'Refusing to drop "{name}", only "{BENCH_DATABASE}" is dropped')
+  client.drop_database(name)
+
+
+# Helper function to connect to the benchmark database, in memory unless a MongoDB URI is given
+def connect(args):
+  if args.mongo_uri:
+    from pymongo import MongoClient
+
+    return MongoClient(args.mongo_uri)
+  import mongomock
+  import mongomock.gridfs
+
+  mongomock.gridfs.enable_gridfs_integration()
+  return mongomock.MongoClient()
+
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(
+    description="Benchmark the API against synthetic data"
+  )
+  parser.add_argument("--days", type=int, default=10, help="Days to seed")
+  parser.add_argument("--images", type=int, default=10, help="Images per day")
+  parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+  parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients")
+  parser.add_argument(
+    "--warmup", type=int, default=20, help="Unmeasured requests per scenario"
+  )
+  parser.add_argument(
+    "--seed", type=int, default=0, help="Seed of the synthetic data and requests"
+  )
+  parser.add_argument("--scenarios", nargs="*", help="Scenarios to run (default: all)")
+  parser.add_argument(
+    "--mongo-uri",
+    help=f"MongoDB to seed and serve from, its {BENCH_DATABASE} database is dropped (default: in memory)",
+  )
+  parser.add_argument(
+    "--baseline", default=BASELINE_PATH, help="Baseline to compare with"
+  )
+  parser.add_argument(
+    "--save-baseline", action="store_true", help="Save the results as the baseline"
+  )
+  parser.add_argument(
+    "--tolerance", type=float, default=0.25, help="Allowed regression, as a fraction"
+  )
+  return parser.parse_args(argv)
+
+
+def main(argv=None):
+  args = parse_args(argv)
+  # The app reads its config when imported, so the environment is set first
+  os.environ["ENV"] = "dev"
+  os.environ["MONGO_TOKEN"] = args.mongo_uri or "mongodb://localhost"
+  os.environ["ENSURE_INDEXES"] = "false"
+  from unittest.mock import patch
+  from waitress.server import create_server
+
+  client = connect(args)
+  drop_bench_database(client)
+  db = client[BENCH_DATABASE]
+  ids = seed(db, args.days, args.images, args.seed)
+  rng = random.Random(args.seed)
+  uploads = [generate_image(rng) for _ in range(10)]
+
+  with (
+    patch("imaginate_api.extensions.MongoClient", return_value=client),
+    patch("imaginate_api.extensions.mongo.db_name", BENCH_DATABASE),
+  ):
+    from imaginate_api.app import app
+    from imaginate_api.indexes import ensure_indexes
+
+    with redirect_stdout(sys.stderr):
+      ensure_indexes(db)
+    logging.getLogger("waitress.queue").setLevel(
+      logging.ERROR
+    )  # Queued requests are expected
+    server = create_server(
+      app, host="127.0.0.1", port=0, threads=max(4, args.concurrency)
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.effective_port}"
+
+    scenarios = get_scenarios(args.days, ids, uploads)
+    results = {}
+    for name in args.scenarios or scenarios:
+      with (
+        open(os.devnull, "w") as devnull,
+        redirect_stdout(devnull),
+      ):  # The app logs with print
+        if args.warmup:
+          run_scenario(
+            base_url, scenarios[name], args.warmup, args.concurrency, -args.seed
+          )
+        results[name] = run_scenario(
+          base_url, scenarios[name], args.requests, args.concurrency, args.seed
+        )
+      result = results[name]
+      print(
+        f"{name:24} {result['rps']:>8} req/s  p50 {result['p50_ms']:>8} ms  "
+        f"p99 {result['p99_ms']:>8} ms  errors {result['errors']}"
+      )
+    server.close()
+
+  peak_rss_mb = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+  print(f"Peak RSS: {peak_rss_mb} MB")
+  arguments = {name: getattr(args, name) for name in COMPARED_ARGUMENTS}
+  report = {"arguments": arguments, "results": results, "peak_rss_mb": peak_rss_mb}
+
+  if args.save_baseline:
+    with open(args.baseline, "w") as file:
+      json.dump(report, file, indent=2)
+      file.write("\n")
+    print(f"Saved baseline to {args.baseline}")
+    return 0
+
+  if not os.path.exists(args.baseline):
+    print("No baseline to compare with, save one with --save-baseline")
+    return 0
+  with open(args.baseline) as file:
+    baseline = json.load(file)
+  if baseline["arguments"] != arguments:
+    print(
+      f"Baseline was run with other arguments ({baseline['arguments']}), not comparing"
+    )
+    return 0
+  regressions = compare(results, baseline["results"], args.tolerance)
+  for regression in regressions:
+    print(f"Regression: {regression}")
+  return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,61 @@
+from imaginate_api.schemas.date_info import DateInfo
+from io import BytesIO
+from PIL import Image
+import gridfs
+import hashlib
+import random
+
+# Explanation of the synthetic data:
+# - Each of the seeded days gets the same number of images and a day document listing them, like production data
+# - Images are stored the way POST /image/create stores them (see image/storage.py), so reads take the same paths
+# - Images are JPEGs of noise over a gradient at common photo sizes, a few hundred KB like photos
+# - Everything is drawn from a seeded random generator, so the same arguments always seed the same data
+
+# Photo sizes images are drawn from, as (width, height)
+IMAGE_SIZES = [(1024, 768), (1280, 853), (800, 600), (1080, 1080)]
+
+THEMES = ["animals", "architecture", "food", "landscape", "people"]
+
+
+# Generate the JPEG bytes of a synthetic photo
+def generate_image(rng: random.Random, size: tuple[int, int] | None = None):
+  width, height = size or rng.choice(IMAGE_SIZES)
+  noise = Image.frombytes(
+    "RGB", (width // 2, height // 2), rng.randbytes(width // 2 * height // 2 * 3)
+  ).resize((width, height))
+  gradient = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+  output = BytesIO()
+  Image.blend(gradient, noise, 0.35).save(output, "JPEG", quality=rng.randint(75, 90))
+  return output.getvalue()
+
+
+# Seed days of images into a database, returning the IDs of the images stored
+# The database should be empty, seeding does not remove what is already there
+def seed(db, days: int, images_per_day: int, seed_value: int = 0):
+  rng = random.Random(seed_value)
+  fs = gridfs.GridFS(db)
+  ids = []
+  for day in range(days):
+    date = DateInfo.START_DATE.value + day * DateInfo.SECONDS_PER_DAY.value
+    day_ids = []
+    for index in range(images_per_day):
+      data = generate_image(rng)
+      day_ids.append(
+        fs.put(
+          data,
+          filename=f"day-{day}-{index}.jpg",
+          type="image/jpeg",
+          date=date,
+          theme=rng.choice(THEMES),
+          real=rng.random() < 0.5,
+          status="verified",
+          sha256=hashlib.sha256(data).hexdigest(),
+          refs=1,
+        )
+      )
+    db["days"].insert_one(
+      {"_id": date, "day": day, "images": day_ids, "appearances": []}
+    )
+    ids += day_ids
+  print(f"Seeded {days} days of {images_per_day} images")
+  return ids
@@ -3,9 +3,18 @@ from flask_cors import CORS
 from werkzeug.exceptions import HTTPException
 from imaginate_api.date.routes import bp as date_routes
 from imaginate_api.image.routes import bp as image_routes
+from imaginate_api.job.routes import bp as job_routes
 from imaginate_api.user.routes import bp as user_routes
 from imaginate_api.config import Config
+from imaginate_api import compression, jobs, metrics, profiling
 from imaginate_api.extensions import login_manager
+from imaginate_api.image.purge import sweep_orphaned_chunks_command
+from imaginate_api.schemas.user_info import merge_duplicate_users_command
+from imaginate_api.indexes import (
+  ensure_indexes,
+  ensure_indexes_command,
+  check_query_plans_command,
+)
 import os
 
 
@@ -14,10 +23,19 @@ def create_app():
   CORS(app)
   app.config.from_object(Config)
   login_manager.init_app(app)
+  metrics.init_app(app)  # Before compression, so its hooks see compressed responses
+  compression.init_app(app)
+  jobs.init_app(app)
   app.secret_key = os.getenv("FLASK_SECRET_KEY")
   app.register_blueprint(date_routes, url_prefix="/date")
   app.register_blueprint(image_routes, url_prefix="/image")
   app.register_blueprint(user_routes, url_prefix="/user")
+  app.register_blueprint(job_routes, url_prefix="/jobs")
+  app.cli.add_command(ensure_indexes_command)
+  app.cli.add_command(check_query_plans_command)
+  app.cli.add_command(sweep_orphaned_chunks_command)
+  app.cli.add_command(merge_duplicate_users_command)
+  profiling.init_app(app)  # Last, so the whole app is profiled
   return app
 
 
@@ -48,9 +66,11 @@ def handle_exception(exc: HTTPException):
 
 # Run app on invocation
 if __name__ == "__main__":
+  if app.config["ENSURE_INDEXES"]:
+    ensure_indexes()
   if app.config["DB_ENV"] == "prod":
-    from waitress import serve
+    from imaginate_api.server import run
 
-    serve(app, host="0.0.0.0", port=8080)
+    run(app)
   else:
     app.run()
@@ -0,0 +1,359 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from imaginate_api.config import Config
+import hashlib
+import os
+import struct
+import tempfile
+import threading
+import time
+
+try:
+  import fcntl
+except ImportError:  # Not available on Windows, where the disk backend cannot count
+  fcntl = None
+
+try:
+  import redis
+except ImportError:  # Optional, only needed by the redis backend
+  redis = None
+
+# Explanation of the cache backends:
+# - Caches of the date, image and user modules store bytes under string keys in a backend chosen by CACHE_BACKEND
+# - "local" keeps entries in the memory of each process, so it suits a single worker (and tests), the production server
+#   refuses it with several workers since their caches would not see each other's invalidations
+# - "disk" keeps entries as files in CACHE_DIR, shared by every worker on the host (the default directory is in
+#   /dev/shm when it exists, i.e. shared memory)
+# - "redis" keeps entries in the Redis server at CACHE_URL, shared by every worker on every host (needs the redis package)
+# - Deleting keys or incrementing counters is seen by every worker sharing the backend, which is how caches invalidate
+
+
+# Least recently used cache bounded by the total size of its values, sizes are given when storing values
+# - Values larger than max_item_bytes are not stored, storing a value evicts the least recently used ones until it fits
+# - Hits, misses and evictions are counted, see stats()
+class LRUCache:
+  def __init__(self, max_bytes: int, max_item_bytes: int | None = None):
+    self.max_bytes = max_bytes
+    self.max_item_bytes = max_bytes if max_item_bytes is None else max_item_bytes
+    self._entries = OrderedDict()  # Key -> (value, size), least recently used first
+    self._size = 0
+    self._hits = 0
+    self._misses = 0
+    self._evictions = 0
+    self._lock = threading.Lock()
+
+  # Check if a value of the given size can be stored at all
+  def fits(self, size: int):
+    return size <= min(self.max_bytes, self.max_item_bytes)
+
+  def get(self, key, default=None):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        self._misses += 1
+        return default
+      self._entries.move_to_end(key)
+      self._hits += 1
+      return entry[0]
+
+  # Store a value, returning whether it was stored
+  def set(self, key, value, size: int):
+    if not self.fits(size):
+      return False
+    with self._lock:
+      self._discard(key)
+      while self._size + size > self.max_bytes:
+        _, (_, evicted_size) = self._entries.popitem(last=False)
+        self._size -= evicted_size
+        self._evictions += 1
+      self._entries[key] = (value, size)
+      self._size += size
+    return True
+
+  # Helper function to drop an entry, the lock must be held
+  def _discard(self, key):
+    entry = self._entries.pop(key, None)
+    if entry is not None:
+      self._size -= entry[1]
+
+  def discard(self, key):
+    with self._lock:
+      self._discard(key)
+
+  def keys(self):
+    with self._lock:
+      return list(self._entries)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._size = 0
+
+  def stats(self):
+    with self._lock:
+      return {
+        "entries": len(self._entries),
+        "bytes": self._size,
+        "max_bytes": self.max_bytes,
+        "hits": self._hits,
+        "misses": self._misses,
+        "evictions": self._evictions,
+      }
+
+
+# Interface of the cache backends, values are bytes and ttl is in seconds (None never expires)
+class CacheBackend(ABC):
+  @abstractmethod
+  def get(self, key: str) -> bytes | None:
+    pass
+
+  @abstractmethod
+  def set(self, key: str, value: bytes, ttl: float | None = None):
+    pass
+
+  @abstractmethod
+  def delete(self, *keys: str):
+    pass
+
+  # Counters are kept apart from values and start from 0
+  @abstractmethod
+  def get_counter(self, key: str) -> int:
+    pass
+
+  # Atomically increment a counter, returning its new value
+  @abstractmethod
+  def incr(self, key: str) -> int:
+    pass
+
+  @abstractmethod
+  def clear(self):
+    pass
+
+  def stats(self):
+    return {}
+
+
+# Backend in the memory of the current process, within a budget of max_bytes
+class LocalCache(CacheBackend):
+  def __init__(self, max_bytes: int):
+    self._entries = LRUCache(max_bytes)  # Key -> (value, expiry or None)
+    self._counters = {}
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    entry = self._entries.get(key)
+    if entry is None:
+      return None
+    value, expires = entry
+    if expires is not None and time.time() >= expires:
+      self._entries.discard(key)
+      return None
+    return value
+
+  def set(self, key, value, ttl=None):
+    expires = None if ttl is None else time.time() + ttl
+    self._entries.set(key, (value, expires), len(value))
+
+  def delete(self, *keys):
+    for key in keys:
+      self._entries.discard(key)
+
+  def get_counter(self, key):
+    return self._counters.get(key, 0)
+
+  def incr(self, key):
+    with self._lock:
+      self._counters[key] = self._counters.get(key, 0) + 1
+      return self._counters[key]
+
+  def clear(self):
+    self._entries.clear()
+    with self._lock:
+      self._counters.clear()
+
+  def stats(self):
+    return self._entries.stats()
+
+
+# Backend keeping one file per key in a directory, shared by the processes of a host
+# - Files are replaced atomically, so readers see either the old or the new value
+# - Each file starts with its expiry, expired files are removed when read or pruned
+# - Every PRUNE_INTERVAL writes of a process, the least recently used files are removed until max_bytes fit
+class DiskCache(CacheBackend):
+  HEADER = struct.Struct("d")  # Expiry timestamp, 0 never expires
+  PRUNE_INTERVAL = 100
+
+  def __init__(self, directory: str, max_bytes: int):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self._writes = 0
+    os.makedirs(directory, exist_ok=True)
+
+  # Helper function to get the path of a key, hashed so any key is a valid file name
+  def _path(self, key: str):
+    return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+  def get(self, key):
+    path = self._path(key)
+    try:
+      with open(path, "rb") as file:
+        data = file.read()
+    except FileNotFoundError:
+      return None
+    (expires,) = self.HEADER.unpack_from(data)
+    if expires and time.time() >= expires:
+      self.delete(key)
+      return None
+    os.utime(path)  # Mark as recently used for pruning
+    return data[self.HEADER.size :]
+
+  def set(self, key, value, ttl=None):
+    expires = 0 if ttl is None else time.time() + ttl
+    fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+    try:
+      with os.fdopen(fd, "wb") as file:
+        file.write(self.HEADER.pack(expires))
+        file.write(value)
+      os.replace(temp_path, self._path(key))
+    except BaseException:
+      os.unlink(temp_path)
+      raise
+    self._writes += 1
+    if self._writes % self.PRUNE_INTERVAL == 0:
+      self.prune()
+
+  def delete(self, *keys):
+    for key in keys:
+      try:
+        os.unlink(self._path(key))
+      except FileNotFoundError:
+        pass
+
+  # Counters are kept in their own files, locked while they are incremented
+  def get_counter(self, key):
+    try:
+      with open(self._path(key) + ".counter", "rb") as file:
+        if fcntl is not None:
+          fcntl.flock(file, fcntl.LOCK_SH)  # Not halfway through an increment
+        return int(file.read() or 0)
+    except FileNotFoundError:
+      return 0
+
+  def incr(self, key):
+    if fcntl is None:
+      raise RuntimeError("The disk cache backend needs fcntl to count")
+    with open(self._path(key) + ".counter", "a+b") as file:
+      fcntl.flock(file, fcntl.LOCK_EX)
+      file.seek(0)
+      value = int(file.read() or 0) + 1
+      file.seek(0)
+      file.truncate()
+      file.write(str(value).encode())
+      return value
+
+  # Helper function to list the files of entries, leaving out counters and files being written
+  def _entries(self):
+    return [
+      entry
+      for entry in os.scandir(self.directory)
+      if not (entry.name.startswith(".") or entry.name.endswith(".counter"))
+    ]
+
+  # Remove expired files, then the least recently used ones until the directory is within max_bytes
+  def prune(self):
+    files = []
+    for entry in self._entries():
+      try:
+        with open(entry.path, "rb") as file:
+          (expires,) = self.HEADER.unpack(file.read(self.HEADER.size))
+        stat = entry.stat()
+      except (FileNotFoundError, struct.error):
+        continue
+      if expires and time.time() >= expires:
+        self._unlink(entry.path)
+      else:
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    size = sum(file_size for _, file_size, _ in files)
+    for _, file_size, path in sorted(files):
+      if size <= self.max_bytes:
+        break
+      self._unlink(path)
+      size -= file_size
+
+  # Helper function to remove a file that another process may have removed already
+  def _unlink(self, path: str):
+    try:
+      os.unlink(path)
+    except FileNotFoundError:
+      pass
+
+  def clear(self):
+    for entry in os.scandir(self.directory):
+      self._unlink(entry.path)
+
+  def stats(self):
+    entries = self._entries()
+    return {
+      "entries": len(entries),
+      "bytes": sum(entry.stat().st_size for entry in entries),
+      "max_bytes": self.max_bytes,
+    }
+
+
+# Backend in a Redis server, shared by every process that connects to it
+# Keys are prefixed so that clear() only removes the entries of this application
+class RedisCache(CacheBackend):
+  def __init__(self, url: str, prefix: str = "imaginate:"):
+    if redis is None:
+      raise RuntimeError('The redis cache backend needs the "redis" package')
+    self.prefix = prefix
+    self._client = redis.Redis.from_url(url)
+
+  def get(self, key):
+    return self._client.get(self.prefix + key)
+
+  def set(self, key, value, ttl=None):
+    self._client.set(
+      self.prefix + key, value, px=None if ttl is None else max(1, int(ttl * 1000))
+    )
+
+  def delete(self, *keys):
+    if keys:
+      self._client.delete(*(self.prefix + key for key in keys))
+
+  def get_counter(self, key):
+    return int(self._client.get(self.prefix + "counter:" + key) or 0)
+
+  def incr(self, key):
+    return self._client.incr(self.prefix + "counter:" + key)
+
+  def clear(self):
+    for key in self._client.scan_iter(match=self.prefix + "*"):
+      self._client.delete(key)
+
+  def stats(self):
+    info = self._client.info("stats")
+    return {"hits": info.get("keyspace_hits"), "misses": info.get("keyspace_misses")}
+
+
+# Helper function to get the cache backend chosen by the config, workers of the server share one by default
+def get_backend_name(config=Config):
+  if config.CACHE_BACKEND:
+    return config.CACHE_BACKEND
+  return "disk" if config.SERVER_WORKERS > 1 else "local"
+
+
+# Helper function to create the cache backend chosen by the config
+def create_cache(config=Config):
+  name = get_backend_name(config)
+  if name == "local":
+    return LocalCache(config.CACHE_MAX_BYTES)
+  if name == "disk":
+    return DiskCache(config.CACHE_DIR, config.CACHE_MAX_BYTES)
+  if name == "redis":
+    return RedisCache(config.CACHE_URL)
+  raise RuntimeError(f'Unknown cache backend "{name}"')
+
+
+cache = create_cache()
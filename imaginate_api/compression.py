@@ -0,0 +1,101 @@
+from flask import current_app, request
+import gzip
+
+try:
+  import brotli
+except ImportError:  # Optional, clients are offered the other encodings
+  brotli = None
+
+try:
+  import zstandard
+except ImportError:  # Optional, clients are offered the other encodings
+  zstandard = None
+
+# Explanation of response compression:
+# - Responses are compressed with the encoding the client prefers (Accept-Encoding) among br, zstd and gzip
+#   (br and zstd need the brotli and zstandard packages of the "compression" extra, gzip is always available)
+# - Only textual responses of at least COMPRESSION_MIN_SIZE bytes are compressed, at COMPRESSION_LEVEL
+# - Streamed and already encoded responses are left alone, cached payloads keep their compressed bodies instead
+#   (see date/bundle.py) so the same bytes are not compressed for every request
+
+COMPRESSIBLE_MIMETYPES = {
+  "application/json",
+  "application/javascript",
+  "text/css",
+  "text/html",
+  "text/plain",
+}
+
+
+def compress_gzip(data: bytes, level: int):
+  return gzip.compress(data, compresslevel=min(level, 9), mtime=0)
+
+
+def compress_brotli(data: bytes, level: int):
+  return brotli.compress(data, quality=min(level, 11))
+
+
+def compress_zstd(data: bytes, level: int):
+  return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+# Available encodings in order of preference, when the client accepts several equally
+ENCODERS = {}
+if brotli is not None:
+  ENCODERS["br"] = compress_brotli
+if zstandard is not None:
+  ENCODERS["zstd"] = compress_zstd
+ENCODERS["gzip"] = compress_gzip
+
+
+# Helper function to pick the encoding of a response among encodings, or None when the client accepts none of them
+def choose_encoding(accept_encodings, encodings=ENCODERS):
+  best, best_quality = None, 0
+  for name in encodings:
+    quality = accept_encodings[name]
+    if quality > best_quality:
+      best, best_quality = name, quality
+  return best
+
+
+# Compress data with every available encoding, for payloads that are cached and served many times
+# Returns encoding -> compressed data, leaving out encodings that do not make the data smaller
+def compress_all(data: bytes):
+  config = current_app.config
+  if len(data) < config["COMPRESSION_MIN_SIZE"]:
+    return {}
+  encoded = {}
+  for name, encoder in ENCODERS.items():
+    compressed = encoder(data, config["COMPRESSION_LEVEL"])
+    if len(compressed) < len(data):
+      encoded[name] = compressed
+  return encoded
+
+
+# Compress a response when it is worth it and the client accepts it, see init_app
+def compress_response(response):
+  if (
+    response.direct_passthrough
+    or response.is_streamed
+    or "Content-Encoding" in response.headers
+    or response.status_code != 200
+    or response.mimetype not in COMPRESSIBLE_MIMETYPES
+  ):
+    return response
+
+  response.vary.add("Accept-Encoding")
+  config = current_app.config
+  data = response.get_data()
+  encoding = choose_encoding(request.accept_encodings)
+  if encoding is None or len(data) < config["COMPRESSION_MIN_SIZE"]:
+    return response
+  response.set_data(ENCODERS[encoding](data, config["COMPRESSION_LEVEL"]))
+  response.headers["Content-Encoding"] = encoding
+  etag, weak = response.get_etag()
+  if etag and not weak:
+    response.set_etag(etag, weak=True)  # Same content, different bytes
+  return response
+
+
+def init_app(app):
+  app.after_request(compress_response)
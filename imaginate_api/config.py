@@ -1,4 +1,5 @@
 import os
+import tempfile
 from dotenv import load_dotenv
 import sys
 
@@ -39,3 +40,80 @@ class Config:
     "https://playimaginate.com" if DB_ENV == "prod" else "http://localhost:5173"
   )
   TESTING = False
+  LATEST_DATE_TTL = int(os.getenv("LATEST_DATE_TTL", 60))  # Seconds
+  ENSURE_INDEXES = os.getenv("ENSURE_INDEXES", "true").lower() == "true"
+  BULK_CREATE_WORKERS = int(os.getenv("BULK_CREATE_WORKERS", 8))
+  BULK_CREATE_MAX_ITEMS = int(os.getenv("BULK_CREATE_MAX_ITEMS", 100))
+  OUTBOUND_CONNECT_TIMEOUT = float(os.getenv("OUTBOUND_CONNECT_TIMEOUT", 3.05))
+  OUTBOUND_READ_TIMEOUT = float(os.getenv("OUTBOUND_READ_TIMEOUT", 20))
+  OUTBOUND_RETRIES = int(os.getenv("OUTBOUND_RETRIES", 3))
+  OUTBOUND_BACKOFF = float(os.getenv("OUTBOUND_BACKOFF", 0.5))  # Doubled per retry
+  OUTBOUND_POOL_HOSTS = int(os.getenv("OUTBOUND_POOL_HOSTS", 10))
+  OUTBOUND_POOL_SIZE = int(os.getenv("OUTBOUND_POOL_SIZE", 16))  # Connections per host
+  OUTBOUND_MAX_CONCURRENCY = int(os.getenv("OUTBOUND_MAX_CONCURRENCY", 16))
+  # Size the pool to the number of server threads, see https://pymongo.readthedocs.io/en/stable/faq.html#how-does-connection-pooling-work-in-pymongo
+  MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+  MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+  MONGO_WAIT_QUEUE_TIMEOUT_MS = (
+    int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS"))
+    if os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS")
+    else None
+  )
+  MONGO_READ_PREFERENCE = os.getenv("MONGO_READ_PREFERENCE", "primary")
+  MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS")  # E.g. "zstd,snappy,zlib"
+  RENDITION_QUALITY = int(os.getenv("RENDITION_QUALITY", 80))
+  RENDITIONS_ON_INGEST = os.getenv("RENDITIONS_ON_INGEST", "false").lower() == "true"
+  # Cache backend shared by the date, image and user caches, see cache.py
+  # "local", "disk" or "redis", by default "disk" with several server workers and "local" otherwise
+  CACHE_BACKEND = os.getenv("CACHE_BACKEND")
+  CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", 128 << 20))
+  CACHE_DIR = os.getenv(
+    "CACHE_DIR",
+    os.path.join(  # One per environment, so dev and prod servers on a host do not share entries
+      "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+      f"imaginate-cache-{DB_ENV}",
+    ),
+  )
+  CACHE_URL = os.getenv("CACHE_URL", "redis://localhost:6379/0")
+  IMAGE_CACHE_MAX_ITEM_BYTES = int(os.getenv("IMAGE_CACHE_MAX_ITEM_BYTES", 8 << 20))
+  IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", 24 * 60 * 60))  # Seconds
+  USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 5 * 60))  # Seconds
+  USER_CACHE_LOCAL_TTL = int(os.getenv("USER_CACHE_LOCAL_TTL", 10))  # Seconds
+  USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", 10000))
+  # Verification queue, see image/verification.py
+  VERIFICATION_CLAIM_TTL = int(os.getenv("VERIFICATION_CLAIM_TTL", 5 * 60))  # Seconds
+  VERIFICATION_BATCH_SIZE = int(os.getenv("VERIFICATION_BATCH_SIZE", 10))
+  VERIFICATION_MAX_BATCH = int(os.getenv("VERIFICATION_MAX_BATCH", 100))
+  # Response compression, see compression.py
+  COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 500))  # Bytes
+  COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", 6))
+  # Production server, see server.py
+  SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+  SERVER_PORT = int(os.getenv("SERVER_PORT", 8080))
+  # Set it for each deployment: the CPUs of the host are not those of a container's quota (e.g. on Cloud Run), and each
+  # worker has its own MongoDB connection pool and thread pools
+  SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", 1))
+  SERVER_THREADS = int(os.getenv("SERVER_THREADS", 8))  # Per worker
+  SERVER_CONNECTION_LIMIT = int(os.getenv("SERVER_CONNECTION_LIMIT", 100))  # Per worker
+  SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", 1024))
+  SERVER_CHANNEL_TIMEOUT = int(os.getenv("SERVER_CHANNEL_TIMEOUT", 120))  # Seconds
+  SERVER_GRACEFUL_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", 30))  # Seconds
+  # Purges of rejected images, see image/purge.py
+  PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", 500))
+  PURGE_BACKGROUND_THRESHOLD = int(os.getenv("PURGE_BACKGROUND_THRESHOLD", 1000))
+  # Background jobs, see jobs.py
+  JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))  # Threads per process
+  JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+  # Seconds before the first retry of a job, doubled on each attempt
+  JOB_RETRY_BACKOFF = float(os.getenv("JOB_RETRY_BACKOFF", 5))
+  JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", 10 * 60))
+  # Request and MongoDB metrics on GET /metrics, see metrics.py
+  METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+  # Opt-in request profiling, see profiling.py
+  PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+  PROFILING_TOKEN = os.getenv("PROFILING_TOKEN")  # Sent in the X-Profile header
+  PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", 0))
+  PROFILING_DIR = os.getenv(
+    "PROFILING_DIR", os.path.join(tempfile.gettempdir(), "imaginate-profiles")
+  )
+  PROFILING_MAX_FILES = int(os.getenv("PROFILING_MAX_FILES", 100))
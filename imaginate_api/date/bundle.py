@@ -0,0 +1,135 @@
+from bson.objectid import ObjectId
+from imaginate_api.cache import cache
+from imaginate_api.schemas.date_info import DateInfo
+from datetime import datetime, timezone
+import hashlib
+import json
+import threading
+import time
+
+# Explanation of the daily bundle cache:
+# - The payload of GET /date/<day>/images is identical for every player, so it is serialized once per resolved date
+# - Requested days are mapped to their resolved date (aliases) so repeated requests skip the resolution queries entirely
+# - Each delivery mode (see GET /date/<day>/images) is cached as its own variant of the resolved date
+# - Bundles and aliases are kept in the cache backend (see cache.py), so workers sharing a backend share them
+# - Bundles and aliases expire when the day rolls over, or earlier when any image is created, updated or deleted:
+#   their keys contain a generation counter which invalidation increments, so every worker stops using them at once
+
+
+# Helper function to get the timestamp at which the current day rolls over
+def next_rollover(now: float | None = None):
+  now = time.time() if now is None else now
+  start = DateInfo.START_DATE.value
+  length = DateInfo.SECONDS_PER_DAY.value
+  return start + (int(now - start) // length + 1) * length
+
+
+# A fully serialized payload along with the validators used for conditional requests
+# Compressed copies of the body can be kept along with it, see compression.py
+class Bundle:
+  def __init__(
+    self,
+    body: bytes,
+    image_ids=(),
+    expires: float | None = None,
+    etag: str | None = None,
+    last_modified: datetime | None = None,
+    encoded: dict | None = None,
+  ):
+    self.body = body
+    self.encoded = encoded or {}  # Encoding -> compressed body
+    self.image_ids = tuple(image_ids)  # Kept in payload order
+    self.etag = etag or hashlib.sha256(body).hexdigest()
+    self.last_modified = last_modified or datetime.now(timezone.utc).replace(
+      microsecond=0
+    )
+    self.expires = next_rollover() if expires is None else expires
+
+  # Serialize for the cache backend, as a JSON header line followed by the body and its compressed copies
+  def dumps(self):
+    header = {
+      "image_ids": [str(_id) for _id in self.image_ids],
+      "expires": self.expires,
+      "etag": self.etag,
+      "last_modified": self.last_modified.timestamp(),
+      "encoded": {name: len(data) for name, data in self.encoded.items()},
+    }
+    return b"".join(
+      [json.dumps(header).encode("utf-8"), b"\n", self.body, *self.encoded.values()]
+    )
+
+  @classmethod
+  def loads(cls, data: bytes):
+    header, payload = data.split(b"\n", 1)
+    header = json.loads(header)
+    end = len(payload) - sum(header["encoded"].values())
+    body, encoded = payload[:end], {}
+    for name, length in header["encoded"].items():
+      encoded[name] = payload[end : end + length]
+      end += length
+    return cls(
+      body,
+      image_ids=[ObjectId(_id) for _id in header["image_ids"]],
+      expires=header["expires"],
+      etag=header["etag"],
+      last_modified=datetime.fromtimestamp(header["last_modified"], timezone.utc),
+      encoded=encoded,
+    )
+
+
+class BundleCache:
+  GENERATION_KEY = "bundles:generation"
+
+  def __init__(self, backend):
+    self._backend = backend
+    self._building = {}  # Bundle key -> Lock, so concurrent misses of a process only build once
+    self._lock = threading.Lock()
+
+  # Helper function to get the key of an entry in the current generation
+  # Entries stored while an invalidation happens land in the previous generation, where nobody reads them
+  def _key(self, *parts):
+    generation = self._backend.get_counter(self.GENERATION_KEY)
+    return ":".join(["bundles", str(generation), *map(str, parts)])
+
+  # Get the resolved date of a requested day, calling resolver only when it is not cached
+  def resolve(self, day, resolver):
+    key = self._key("alias", day)
+    alias = self._backend.get(key)
+    if alias is not None:
+      return json.loads(alias)
+
+    date = resolver()
+    self._backend.set(
+      key, json.dumps(date).encode("utf-8"), next_rollover() - time.time()
+    )
+    return date
+
+  # Get the bundle of a resolved date, calling builder (which returns a Bundle) only when it is not cached
+  def get(self, date, builder, variant=None):
+    key = self._key(date, variant)
+    data = self._backend.get(key)
+    if data is not None:
+      return Bundle.loads(data)
+
+    with self._lock:
+      build_lock = self._building.setdefault(key, threading.Lock())
+    try:
+      with build_lock:
+        # Another thread may have built it while we waited
+        data = self._backend.get(key)
+        if data is not None:
+          return Bundle.loads(data)
+        bundle = builder()
+        self._backend.set(key, bundle.dumps(), max(0, bundle.expires - time.time()))
+        return bundle
+    finally:
+      with self._lock:
+        self._building.pop(key, None)
+
+  # Drop every bundle and alias, since images changed
+  # Aliases are dropped too as new content can change how requested days resolve
+  def invalidate(self):
+    self._backend.incr(self.GENERATION_KEY)
+
+
+bundles = BundleCache(cache)
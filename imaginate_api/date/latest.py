@@ -0,0 +1,71 @@
+from flask import current_app
+from imaginate_api.cache import cache
+from imaginate_api.extensions import fs
+import json
+import threading
+
+
+# Cache of the latest date in the database, so requests do not sort fs.files
+# - The value is kept in the cache backend (see cache.py), so workers sharing a backend share it
+# - Its key contains a generation counter like bundles (see date/bundle.py): uploads past the cached date and deletes of
+#   it increment the counter atomically, which forces a new lookup, and values looked up meanwhile land in the previous
+#   generation where nobody reads them
+# - The TTL bounds how stale the value can get when something else changes the database
+class LatestDateCache:
+  GENERATION_KEY = "latest:generation"
+
+  def __init__(self, backend):
+    self._backend = backend
+    self._lock = threading.Lock()
+
+  # Helper function to get the key of the value in the current generation
+  def _key(self):
+    return f"latest:{self._backend.get_counter(self.GENERATION_KEY)}:date"
+
+  # Helper function to get the cached value as (date,) or None when it is not cached
+  def _get_cached(self, key: str):
+    data = self._backend.get(key)
+    return None if data is None else (json.loads(data),)
+
+  # Helper function to cache a date
+  def _set_cached(self, key: str, date: int | None):
+    self._backend.set(
+      key, json.dumps(date).encode("utf-8"), current_app.config["LATEST_DATE_TTL"]
+    )
+
+  # Get the latest date, or None for an empty database
+  def get(self):
+    key = self._key()
+    cached = self._get_cached(key)
+    if cached is not None:
+      return cached[0]
+
+    with self._lock:
+      key = self._key()
+      cached = self._get_cached(key)  # Another thread may have looked it up
+      if cached is not None:
+        return cached[0]
+      # Explanation for this query: https://www.mongodb.com/docs/manual/core/aggregation-pipeline-optimization/#-sort----limit-coalescence
+      res = next(fs.find({}).sort({"date": -1}).limit(1), None)  # Descending sort
+      date = res.date if res else None
+      self._set_cached(key, date)
+      return date
+
+  # Record a newly uploaded date, only a date past the cached one requires a new lookup
+  # Without a cached value a lookup may be in flight and miss the date, so the counter is incremented too
+  def bump(self, date: int):
+    cached = self._get_cached(self._key())
+    if cached is None or cached[0] is None or date > cached[0]:
+      self._backend.incr(self.GENERATION_KEY)
+
+  # Record a deleted date, only the latest date being deleted (or a lookup in flight) requires a new lookup
+  def discard(self, date: int | None = None):
+    cached = self._get_cached(self._key())
+    if date is None or cached is None or cached[0] == date:
+      self._backend.incr(self.GENERATION_KEY)
+
+  def clear(self):
+    self.discard()
+
+
+latest = LatestDateCache(cache)
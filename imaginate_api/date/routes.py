@@ -1,8 +1,29 @@
-from flask import Blueprint, abort, jsonify
+from flask import (
+  Blueprint,
+  abort,
+  current_app,
+  json,
+  jsonify,
+  request,
+  stream_with_context,
+)
+from imaginate_api.compression import choose_encoding, compress_all
+from imaginate_api.date.bundle import Bundle, bundles
+from imaginate_api.date.latest import latest
 from imaginate_api.extensions import fs, db
-from imaginate_api.utils import build_result, calculate_date
+from imaginate_api.image.cache import image_cache
+from imaginate_api.image.purge import purge_or_start
+from imaginate_api.jobs import build_job_response
+from imaginate_api.utils import (
+  build_result,
+  calculate_date,
+  iter_grid_out,
+  resolve_blob,
+)
 from http import HTTPStatus
+from werkzeug.exceptions import NotFound
 from base64 import b64encode
+import secrets
 
 bp = Blueprint("date", __name__)
 
@@ -13,26 +34,55 @@ bp = Blueprint("date", __name__)
 #   - Examples: ID: 0 -> Date: September 1st 2024; ID: 1 -> Date: September 2nd 2024; ID: 10 -> Date: September 11th 2024
 
 
-# GET /date/<day>/images: used for viewing images of a specified date
-@bp.route("/<day>/images")
-def images_by_date(day):
+# Helper function to resolve a requested day to the date of the content it shows
+def resolve_day(day):
   try:
     # This code is from GET /date/latest and is NOT internally called for aws/build_lambda_code.py
-    res = next(fs.find().sort({"date": -1}).limit(1), None)  # Descending sort
-    if not res:
+    latest_day = latest.get()
+    if latest_day is None:
       abort(HTTPStatus.NOT_FOUND, description="Empty database")
 
-    date = calculate_date(day, db, res.date)
+    date = calculate_date(day, db, latest_day)
     if not date:
       abort(HTTPStatus.BAD_REQUEST, description="Invalid date")
   except ValueError:
     abort(HTTPStatus.BAD_REQUEST, description="Invalid date")
+  return date
+
+
+# Delivery modes of GET /date/<day>/images:
+# - inline: JSON array of image results with the base64 encoded image in "data" (default)
+# - manifest: JSON array of image results only, clients fetch each "url" themselves
+# - multipart: multipart/mixed stream whose first part is the manifest, followed by the raw bytes of each image
+DELIVERY_MODES = ["inline", "manifest", "multipart"]
 
-  day_document = db['days'].find_one(
+
+# Helper function to negotiate the delivery mode through the format query parameter or Accept header
+def get_delivery_mode():
+  mode = request.args.get("format")
+  if mode is None:
+    best = request.accept_mimetypes.best_match(["application/json", "multipart/mixed"])
+    mode = "multipart" if best == "multipart/mixed" else "inline"
+  if mode not in DELIVERY_MODES:
+    abort(
+      HTTPStatus.BAD_REQUEST, description=f"Format should be one of: {DELIVERY_MODES}"
+    )
+  return mode
+
+
+# Helper function to serialize the images of a resolved date into a bundle
+def build_day_bundle(date, inline=True):
+  day_document = db["days"].find_one(
     {"_id": date},
   )
-  res = fs.find({"_id": {"$in": day_document.get("images", [])}})
+  if not day_document:
+    abort(HTTPStatus.NOT_FOUND, description="No images for date")
+  # Deleted images may still be listed, kept as hidden blobs when their content is shared (see image/storage.py)
+  res = fs.find(
+    {"_id": {"$in": day_document.get("images", [])}, "kind": {"$exists": False}}
+  )
   out = []
+  image_ids = []
   for document in res:
     current_res = build_result(
       document._id,
@@ -42,20 +92,79 @@ def images_by_date(day):
       document.status,
       document.filename,
     )
-    encoded_data = b64encode(document.read())
-    current_res["data"] = encoded_data.decode("utf-8")
+    if inline:
+      encoded_data = b64encode(resolve_blob(document).read())
+      current_res["data"] = encoded_data.decode("utf-8")
     out.append(current_res)
-  return jsonify(out)
+    image_ids.append(document._id)
+  body = json.dumps(out).encode("utf-8")
+  return Bundle(body, image_ids=image_ids, encoded=compress_all(body))
+
+
+# Helper function to stream a manifest bundle followed by its images as multipart parts
+def stream_multipart(bundle, boundary):
+  yield f"--{boundary}\r\nContent-Type: application/json\r\n\r\n".encode()
+  yield bundle.body
+  for _id in bundle.image_ids:
+    try:
+      document = image_cache.get(_id)
+    except NotFound:
+      continue  # Deleted since the manifest was built
+    content = resolve_blob(document)
+    yield (
+      f"\r\n--{boundary}\r\n"
+      f"Content-Type: {document.type}\r\n"
+      f"Content-ID: <{_id}>\r\n"
+      f"Content-Length: {content.length}\r\n\r\n"
+    ).encode()
+    yield from iter_grid_out(content)
+  yield f"\r\n--{boundary}--\r\n".encode()
+
+
+# GET /date/<day>/images: used for viewing images of a specified date
+# The serialized payload is cached per resolved date and delivery mode, see date/bundle.py
+# JSON payloads are cached compressed too, and sent in the encoding the client prefers
+@bp.route("/<day>/images")
+def images_by_date(day):
+  mode = get_delivery_mode()
+  date = bundles.resolve(day, lambda: resolve_day(day))
+  inline = mode == "inline"
+  bundle = bundles.get(date, lambda: build_day_bundle(date, inline), inline)
+
+  if mode == "multipart":
+    boundary = secrets.token_hex(16)
+    response = current_app.response_class(
+      stream_with_context(stream_multipart(bundle, boundary)),
+      mimetype=f"multipart/mixed; boundary={boundary}",
+    )
+    response.set_etag(f"{bundle.etag}-{mode}")
+  else:
+    encoding = choose_encoding(request.accept_encodings, bundle.encoded)
+    if encoding:
+      response = current_app.response_class(
+        bundle.encoded[encoding], mimetype="application/json"
+      )
+      response.headers["Content-Encoding"] = encoding
+      response.set_etag(f"{bundle.etag}-{encoding}")
+    else:
+      response = current_app.response_class(bundle.body, mimetype="application/json")
+      response.set_etag(bundle.etag)
+    response.vary.add("Accept-Encoding")
+  response.last_modified = bundle.last_modified
+  response.vary.add("Accept")
+  # Clients always revalidate, which is answered from the cache
+  response.cache_control.public = True
+  response.cache_control.no_cache = True
+  return response.make_conditional(request)
 
 
 # GET /date/latest: used for getting the latest date in the database
 @bp.route("/latest")
 def latest_date():
-  # Explanation for this query: https://www.mongodb.com/docs/manual/core/aggregation-pipeline-optimization/#-sort----limit-coalescence
-  res = next(fs.find().sort({"date": -1}).limit(1), None)  # Descending sort
-  if not res:
+  date = latest.get()
+  if date is None:
     abort(HTTPStatus.NOT_FOUND, description="Empty database")
-  return jsonify({"date": res.date})
+  return jsonify({"date": date})
 
 
 @bp.route("/delete-rejected/<day>", methods=["DELETE"])
@@ -67,13 +176,11 @@ def delete_rejected_by_day(day):
         # Convert the provided day into the expected date format
         date = calculate_date(day)
 
-        # Query the GridFS to find all rejected images for the given date
-        images_to_delete = fs.find({"date": date, "status": "rejected"})
-
-        deleted_count = 0
-        for image in images_to_delete:
-            fs.delete(image._id)
-            deleted_count += 1
+        # Delete all rejected images for the given date in batches, large purges run as a job
+        counts, job_id = purge_or_start({"date": date, "status": "rejected"})
+        if job_id:
+            return build_job_response(job_id)
+        deleted_count = counts["images"]
 
         if deleted_count == 0:
             return jsonify({"message": "No rejected images found for the given date."}), HTTPStatus.NOT_FOUND
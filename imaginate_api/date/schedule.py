@@ -0,0 +1,104 @@
+from imaginate_api.date.bundle import next_rollover
+import threading
+import time
+
+# Explanation of the day schedule:
+# - Day documents record every timestamp they were shown for in their "appearances" array, which is the persisted schedule
+# - The schedule is loaded into memory once per day, so resolving a day that was already assigned does not touch the database
+# - Only a day that was never assigned (i.e. the day rolled over) performs the atomic assignment, once per process
+
+
+# Helper function to get the filter of days that have not appeared yet, or appeared on a timestamp
+# Every clause is an equality on "appearances" so the $or is answered from its index (see indexes.py)
+def get_assignable_filter(timestamp_day: int):
+  return {
+    "$or": [
+      {"appearances": []},
+      {"appearances": timestamp_day},
+      {"appearances": None},  # Missing
+    ]
+  }
+
+
+# Schedule loaded from the day documents, a load builds a new one and swaps it in whole
+class LoadedSchedule:
+  def __init__(self, days: set, assigned: dict, expires: float):
+    self.days = days  # "day" values of existing day documents
+    # Requested timestamp -> content date, or None to fall back to the cycle
+    self.assigned = assigned
+    self.expires = expires
+
+
+class DaySchedule:
+  def __init__(self):
+    self._loaded = LoadedSchedule(set(), {}, 0)
+    self._lock = threading.Lock()  # Held while assigning a day
+    # Held while loading, so an expired schedule is loaded once
+    self._load_lock = threading.Lock()
+
+  # Load the persisted schedule from the day documents
+  def load(self, db):
+    days = set()
+    assigned = {}
+    for document in db["days"].find({}, {"day": 1, "appearances": 1}):
+      if document.get("day") is not None:
+        days.add(document["day"])
+      for appearance in document.get("appearances") or []:
+        assigned[appearance] = document["_id"]
+
+    self._loaded = LoadedSchedule(days, assigned, next_rollover())
+    print(f"Loaded day schedule with {len(days)} days, {len(assigned)} assignments")
+
+  # Helper function to get the loaded schedule, loading it again when it expired
+  def _get_loaded(self, db):
+    loaded = self._loaded
+    if time.time() < loaded.expires:
+      return loaded
+    with self._load_lock:
+      if time.time() >= self._loaded.expires:  # Another thread may have loaded it
+        self.load(db)
+      return self._loaded
+
+  # Get the content date of a requested day, or None when the day should fall back to the cycle
+  def resolve(self, db, day: int, timestamp_day: int):
+    loaded = self._get_loaded(db)
+
+    # Check if the date requested exists regardless of cycle
+    if day in loaded.days:
+      return timestamp_day
+    if timestamp_day in loaded.assigned:
+      return loaded.assigned[timestamp_day]
+
+    with self._lock:
+      if timestamp_day not in loaded.assigned:  # Another thread may have assigned it
+        loaded.assigned[timestamp_day] = self.assign(db, loaded, day, timestamp_day)
+      return loaded.assigned[timestamp_day]
+
+  # Assign content to a requested day that is not in the schedule yet
+  def assign(self, db, loaded: LoadedSchedule, day: int, timestamp_day: int):
+    # The day document may have been created since the schedule was loaded
+    document = db["days"].find_one({"day": day})
+    if document:
+      print("Day for date exists, Circular date ignored")
+      loaded.days.add(day)
+      return timestamp_day
+
+    # Check for days that have not been shown yet
+    new_day = db["days"].find_one_and_update(
+      get_assignable_filter(timestamp_day),
+      # Add the current date to the appearances array
+      {
+        "$addToSet": {"appearances": timestamp_day},
+      },
+      return_document=True,
+    )
+    if new_day:
+      print("New content found, returning date")
+      return new_day["_id"]
+    return None
+
+  def clear(self):
+    self._loaded = LoadedSchedule(set(), {}, 0)
+
+
+schedule = DaySchedule()
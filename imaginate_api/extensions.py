@@ -1,22 +1,85 @@
 from pymongo import MongoClient
 import gridfs
 from imaginate_api.config import Config
-import sys
+from imaginate_api.metrics import command_timer
 from flask_login import LoginManager
+from werkzeug.local import LocalProxy
+import os
+import threading
 
 
-def connect_mongodb(conn_uri: str, db_name: str):
-  client = MongoClient(conn_uri)
+def connect_mongodb(conn_uri: str, db_name: str, **options):
+  client = MongoClient(conn_uri, **options)
 
   # If the connection was not established properly, an exception will be raised by this if statement
   if db_name not in client.list_database_names():
-    print(f'Database "{db_name}" does not exist', file=sys.stderr)
-    sys.exit(1)
+    raise RuntimeError(f'Database "{db_name}" does not exist')
 
-  return client[db_name], gridfs.GridFS(client[db_name])
+  return client, client[db_name], gridfs.GridFS(client[db_name])
+
+
+# Lazy MongoDB connection, the client is only created on first use
+# A client must not be shared with a forked process, so the child creates its own on first use
+class MongoConnection:
+  def __init__(self, conn_uri: str, db_name: str, **options):
+    self.conn_uri = conn_uri
+    self.db_name = db_name
+    self.options = options
+    self._connection = None  # (client, db, fs)
+    self._pid = None
+    self._lock = threading.Lock()
+
+  # Helper function to connect on first use, and again in a forked process
+  def _get_connection(self):
+    if self._connection is not None and self._pid == os.getpid():
+      return self._connection
+
+    with self._lock:
+      if self._connection is None or self._pid != os.getpid():
+        self._connection = connect_mongodb(self.conn_uri, self.db_name, **self.options)
+        self._pid = os.getpid()
+      return self._connection
+
+  @property
+  def client(self):
+    return self._get_connection()[0]
+
+  @property
+  def db(self):
+    return self._get_connection()[1]
+
+  @property
+  def fs(self):
+    return self._get_connection()[2]
+
+  # Forget the current client without closing it, which is what a forked process needs
+  def reset(self):
+    self._connection = None
+    self._pid = None
+
+
+# Helper function to get the client options of the connection pool from the config
+def get_client_options(config=Config):
+  options = {
+    "maxPoolSize": config.MONGO_MAX_POOL_SIZE,
+    "minPoolSize": config.MONGO_MIN_POOL_SIZE,
+    "readPreference": config.MONGO_READ_PREFERENCE,
+  }
+  if config.MONGO_WAIT_QUEUE_TIMEOUT_MS is not None:
+    options["waitQueueTimeoutMS"] = config.MONGO_WAIT_QUEUE_TIMEOUT_MS
+  if config.MONGO_COMPRESSORS:
+    options["compressors"] = config.MONGO_COMPRESSORS
+  if config.METRICS_ENABLED:
+    options["event_listeners"] = [command_timer]
+  return options
 
 
 # Setup
 print(f'Running in "{Config.DB_ENV}" environment')
-db, fs = connect_mongodb(Config.MONGO_TOKEN, f"imaginate_{Config.DB_ENV}")
+mongo = MongoConnection(
+  Config.MONGO_TOKEN, f"imaginate_{Config.DB_ENV}", **get_client_options()
+)
+os.register_at_fork(after_in_child=mongo.reset)
+db = LocalProxy(lambda: mongo.db)
+fs = LocalProxy(lambda: mongo.fs)
 login_manager = LoginManager()
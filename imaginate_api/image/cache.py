@@ -0,0 +1,122 @@
+from bson.objectid import ObjectId
+from imaginate_api.cache import cache
+from imaginate_api.config import Config
+from imaginate_api.image.renditions import (
+  RENDITION_FORMATS,
+  RENDITION_WIDTHS,
+  get_rendition,
+)
+from imaginate_api.utils import resolve_blob, search_id
+import json
+import threading
+
+# Explanation of the image cache:
+# - Hot images are kept in the cache backend (see cache.py) along with their metadata, so serving them skips GridFS
+# - Entries are keyed by image ID for originals and by image ID, width and format for renditions (see image/renditions.py)
+# - The content of an image ID never changes, so entries are only dropped when the image is updated or deleted
+#   (and after IMAGE_CACHE_TTL, which bounds how long a load racing a deletion in another worker can serve it)
+
+# Metadata kept with cached content, which is what the routes read from a GridOut
+CACHED_FIELDS = ["filename", "type", "date", "theme", "real", "status"]
+
+
+# In-memory copy of a GridFS file, read like a GridOut
+class CachedFile:
+  def __init__(self, document: dict, data: bytes):
+    self._document = document
+    self._data = data
+    self._position = 0
+    self.length = len(data)
+
+  def __getattr__(self, name):
+    try:
+      return self._document[name]
+    except KeyError:
+      raise AttributeError(name) from None
+
+  def seek(self, pos: int):
+    self._position = pos
+
+  def read(self, size: int = -1):
+    end = self.length if size < 0 else self._position + size
+    data = self._data[self._position : end]
+    self._position += len(data)
+    return data
+
+  def readchunk(self):
+    return self.read()
+
+
+class ImageCache:
+  def __init__(self, backend, max_item_bytes: int, ttl: float):
+    self._backend = backend
+    self.max_item_bytes = max_item_bytes
+    self.ttl = ttl
+    self._hits = 0
+    self._misses = 0
+    self._generation = (
+      0  # Bumped on invalidation so in-flight loads of this process are dropped
+    )
+    self._lock = threading.Lock()
+
+  # Helper function to get the cache key of an image or one of its renditions
+  def _key(self, _id, *rendition):
+    return ":".join(["images", str(_id), *map(str, rendition)])
+
+  # Helper function to get a cached file, calling loader (which returns a GridOut) only when it is not cached
+  # Files too large for the cache are returned as loaded, to be streamed from GridFS
+  def _get(self, key, loader):
+    data = self._backend.get(key)
+    if data is not None:
+      with self._lock:
+        self._hits += 1
+      header, content = data.split(b"\n", 1)
+      document = json.loads(header)
+      document["_id"] = ObjectId(document["_id"])
+      return CachedFile(document, content)
+
+    with self._lock:
+      self._misses += 1
+      generation = self._generation
+    grid_out = loader()
+    content = resolve_blob(grid_out)
+    if content.length > self.max_item_bytes:
+      return grid_out
+    document = {"_id": str(grid_out._id)}
+    for field in CACHED_FIELDS:
+      document[field] = getattr(grid_out, field, None)
+    data = content.read()
+    with self._lock:
+      if generation == self._generation:
+        header = json.dumps(document).encode("utf-8")
+        self._backend.set(key, header + b"\n" + data, self.ttl)
+    document["_id"] = grid_out._id
+    return CachedFile(document, data)
+
+  # Get an image by ID, aborts when it does not exist
+  def get(self, _id):
+    return self._get(self._key(_id), lambda: search_id(_id))
+
+  # Get a rendition of an image by ID, aborts when the image does not exist
+  def get_rendition(self, _id, width: int, name: str):
+    return self._get(
+      self._key(_id, width, name), lambda: get_rendition(search_id(_id), width, name)
+    )
+
+  # Drop the cached image (and renditions) of an ID, since it was updated or deleted
+  def invalidate(self, _id):
+    with self._lock:
+      self._generation += 1
+    keys = [self._key(_id)]
+    for width in RENDITION_WIDTHS:
+      for name in RENDITION_FORMATS:
+        keys.append(self._key(_id, width, name))
+    self._backend.delete(*keys)
+
+  def stats(self):
+    return {"hits": self._hits, "misses": self._misses}
+
+
+image_cache = ImageCache(
+  cache, Config.IMAGE_CACHE_MAX_ITEM_BYTES, Config.IMAGE_CACHE_TTL
+)
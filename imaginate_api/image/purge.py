@@ -0,0 +1,183 @@
+from bson.objectid import ObjectId
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from imaginate_api.date.bundle import bundles
+from imaginate_api.date.latest import latest
+from imaginate_api.extensions import db
+from imaginate_api.image.cache import image_cache
+from imaginate_api.image.storage import BLOB_KIND, BLOB_UPDATE
+from imaginate_api.jobs import job_type, runner
+from pymongo import UpdateOne
+import click
+
+# Explanation of purges:
+# - A purge selects the IDs of every matching image with one query, then deletes them in batches of PURGE_BATCH_SIZE
+# - Each batch works on all of its images at once with $in: references to deduplicated content are dropped first
+#   (see image/storage.py), then the file documents and chunks of content without references are deleted together
+#   with their renditions
+# - A dry run only reports what would be deleted, purges of more than PURGE_BACKGROUND_THRESHOLD images run as a
+#   background job (see jobs.py)
+# - The sweeper deletes chunks whose file document does not exist, which older purges left behind
+
+# Chunks of files younger than this are never swept, their file document may still be being written
+SWEEP_GRACE_PERIOD = timedelta(hours=1)
+
+
+# Helper function to split a list into batches
+def get_batches(items: list, size: int):
+  for start in range(0, len(items), size):
+    yield items[start : start + size]
+
+
+# Helper function to delete files (documents and chunks) along with their renditions, returning the counts
+def delete_files(ids: list):
+  files, chunks = db["fs.files"], db["fs.chunks"]
+  renditions = [
+    document["_id"]
+    for document in files.find({"rendition_of": {"$in": ids}}, {"_id": 1})
+  ]
+  ids = ids + renditions
+  return {
+    "files": files.delete_many({"_id": {"$in": ids}}).deleted_count,
+    "chunks": chunks.delete_many({"files_id": {"$in": ids}}).deleted_count,
+  }
+
+
+# Helper function to delete a batch of image documents, keeping content that other images still reference
+def purge_batch(documents: list[dict]):
+  files = db["fs.files"]
+  aliases = [document for document in documents if document.get("blob_id")]
+  owners = [document["_id"] for document in documents if not document.get("blob_id")]
+  counts = Counter({"images": len(documents)})
+
+  # Images sharing content only hold a reference to its owner
+  blob_references = Counter(document["blob_id"] for document in aliases)
+  if aliases:
+    files.delete_many({"_id": {"$in": [document["_id"] for document in aliases]}})
+    files.bulk_write(
+      [
+        UpdateOne({"_id": blob_id}, {"$inc": {"refs": -references}})
+        for blob_id, references in blob_references.items()
+      ],
+      ordered=False,
+    )
+
+  # Owners lose their last reference, unless other images still reference them and they become hidden blobs
+  # Like release_blob (see image/storage.py), counts are only zeroed when they are not above 1 so that a concurrent
+  # store cannot lose its reference, owners whose count changed between the updates are handled again
+  pending = owners
+  while pending:
+    files.update_many(
+      {"_id": {"$in": pending}, "refs": {"$not": {"$gt": 1}}},
+      {"$set": {"refs": 0}},
+    )
+    files.update_many(
+      {"_id": {"$in": pending}, "refs": {"$gt": 1}, "kind": {"$ne": BLOB_KIND}},
+      {"$inc": {"refs": -1}, **BLOB_UPDATE},
+    )
+    pending = [
+      document["_id"]
+      for document in files.find(
+        {"_id": {"$in": pending}, "refs": {"$gt": 0}, "kind": {"$ne": BLOB_KIND}},
+        {"_id": 1},
+      )
+    ]
+
+  unreferenced = [
+    document["_id"]
+    for document in files.find(
+      {"_id": {"$in": owners + list(blob_references)}, "refs": {"$lte": 0}},
+      {"_id": 1},
+    )
+  ]
+  if unreferenced:
+    counts.update(delete_files(unreferenced))
+  for document in documents:
+    image_cache.invalidate(document["_id"])
+  return counts
+
+
+# Delete every image matching a query, returning the number of images, file documents and chunks deleted
+# Progress, when given, is called with the counts so far after each batch
+def purge_images(query: dict, dry_run: bool = False, progress=None):
+  files = db["fs.files"]
+  query = {**query, "kind": {"$exists": False}}  # Never renditions or blobs directly
+  documents = list(files.find(query, {"_id": 1, "blob_id": 1, "date": 1, "length": 1}))
+  if dry_run:
+    return {
+      "images": len(documents),
+      "bytes": sum(document.get("length", 0) for document in documents),
+      "dry_run": True,
+    }
+
+  counts = Counter({"images": 0, "files": 0, "chunks": 0})
+  for batch in get_batches(documents, current_app.config["PURGE_BATCH_SIZE"]):
+    counts.update(purge_batch(batch))
+    if progress is not None:
+      progress(dict(counts))
+  if documents:
+    bundles.invalidate()
+    for date in {document.get("date") for document in documents}:
+      latest.discard(date)
+  return dict(counts)
+
+
+@job_type("purge", concurrency=1)
+def run_purge(params: dict, progress):
+  return purge_images(params["query"], progress=progress)
+
+
+# Purge images matching a query, as a background job when there are many of them or when asked to
+# Returns the counts of a purge (or dry run), or the ID of its job
+def purge_or_start(query: dict, dry_run: bool = False, background: bool = False):
+  if dry_run:
+    return purge_images(query, dry_run=True), None
+  threshold = current_app.config["PURGE_BACKGROUND_THRESHOLD"]
+  if (
+    background
+    or db["fs.files"].count_documents({**query, "kind": {"$exists": False}}) > threshold
+  ):
+    return None, runner.submit("purge", {"query": query})
+  return purge_images(query), None
+
+
+# Delete chunks without a file document, returning the number of orphaned files and chunks
+def sweep_orphaned_chunks(dry_run: bool = False):
+  cutoff = ObjectId.from_datetime(datetime.now(timezone.utc) - SWEEP_GRACE_PERIOD)
+  pipeline = [
+    {"$match": {"files_id": {"$lt": cutoff}}},
+    {"$group": {"_id": "$files_id", "chunks": {"$sum": 1}}},
+    {
+      "$lookup": {
+        "from": "fs.files",
+        "localField": "_id",
+        "foreignField": "_id",
+        "as": "file",
+      }
+    },
+    {"$match": {"file": {"$size": 0}}},
+    {"$project": {"chunks": 1}},
+  ]
+  orphans = list(db["fs.chunks"].aggregate(pipeline, allowDiskUse=True))
+  counts = {
+    "files": len(orphans),
+    "chunks": sum(orphan["chunks"] for orphan in orphans),
+  }
+  if dry_run:
+    return {**counts, "dry_run": True}
+
+  counts["chunks"] = 0
+  for batch in get_batches(orphans, current_app.config["PURGE_BATCH_SIZE"]):
+    ids = [orphan["_id"] for orphan in batch]
+    counts["chunks"] += (
+      db["fs.chunks"].delete_many({"files_id": {"$in": ids}}).deleted_count
+    )
+  return counts
+
+
+# CLI: flask --app imaginate_api.app sweep-orphaned-chunks [--dry-run]
+@click.command("sweep-orphaned-chunks")
+@click.option("--dry-run", is_flag=True, help="Only count the orphaned chunks.")
+def sweep_orphaned_chunks_command(dry_run):
+  print(sweep_orphaned_chunks(dry_run))
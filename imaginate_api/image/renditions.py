@@ -0,0 +1,128 @@
+from flask import abort, current_app
+from gridfs.errors import NoFile
+from imaginate_api.extensions import fs
+from imaginate_api.jobs import job_type
+from imaginate_api.utils import resolve_blob
+from http import HTTPStatus
+from io import BytesIO
+from PIL import Image, ImageOps
+import os
+
+# Explanation of renditions:
+# - A rendition is a resized and re-encoded copy of a stored image, stored in GridFS next to it
+# - Rendition files have kind "rendition" and point at their original through "rendition_of", listings skip them
+# - Renditions belong to the file holding the content, so deduplicated images share them (see image/storage.py)
+# - Renditions are made lazily on first request, or by a job on ingest when RENDITIONS_ON_INGEST is set
+
+# Widths renditions are made at, requested widths are rounded up to the nearest one
+RENDITION_WIDTHS = [320, 768, 1280]
+
+# Formats renditions are encoded in, as name -> (Pillow format, content type)
+RENDITION_FORMATS = {
+  "webp": ("WEBP", "image/webp"),
+  "jpeg": ("JPEG", "image/jpeg"),
+}
+
+RENDITION_KIND = "rendition"
+
+
+# Helper function to get the rendition a request asks for through its size and format parameters
+# Returns (width, format) or None when the original image is wanted
+def get_requested_rendition(args, accept_mimetypes):
+  size, name = args.get("size"), args.get("format")
+  if size is None and name is None:
+    return None
+
+  try:
+    size = int(size) if size is not None else RENDITION_WIDTHS[-1]
+  except ValueError:
+    abort(HTTPStatus.BAD_REQUEST, description="Invalid size")
+  if size <= 0:
+    abort(HTTPStatus.BAD_REQUEST, description="Invalid size")
+  width = next(
+    (width for width in RENDITION_WIDTHS if width >= size), RENDITION_WIDTHS[-1]
+  )
+
+  if name is None:
+    # Wildcards (*/* or image/*) match WebP too, so it is only chosen when preferred over JPEG
+    best = accept_mimetypes.best_match(["image/jpeg", "image/webp"])
+    name = "webp" if best == "image/webp" else "jpeg"
+  if name not in RENDITION_FORMATS:
+    abort(
+      HTTPStatus.BAD_REQUEST,
+      description=f"Format should be one of: {list(RENDITION_FORMATS)}",
+    )
+  return width, name
+
+
+# Helper function to resize (never upscale) and re-encode image data
+def render(data: bytes, width: int, name: str):
+  image_format, _ = RENDITION_FORMATS[name]
+  with Image.open(BytesIO(data)) as image:
+    image = ImageOps.exif_transpose(image)
+    if image.width > width:
+      image.thumbnail((width, image.height))
+    if image_format == "JPEG" and image.mode != "RGB":
+      image = image.convert("RGB")
+    output = BytesIO()
+    image.save(output, image_format, quality=current_app.config["RENDITION_QUALITY"])
+  return output.getvalue()
+
+
+# Make and store a rendition of an original GridFS file (whose data can be given), returning it as a GridOut
+def create_rendition(original, width: int, name: str, data: bytes | None = None):
+  _, content_type = RENDITION_FORMATS[name]
+  data = render(original.read() if data is None else data, width, name)
+  stem, _ = os.path.splitext(original.filename or str(original._id))
+  _id = fs.put(
+    data,
+    filename=f"{stem}-{width}.{name}",
+    type=content_type,
+    kind=RENDITION_KIND,
+    rendition_of=original._id,
+    width=width,
+    format=name,
+  )
+  return fs.get(_id)
+
+
+# Get a rendition of an original GridFS file, making it on first request
+# Falls back to the original when it cannot be decoded as an image
+def get_rendition(original, width: int, name: str):
+  content = resolve_blob(original)
+  rendition = fs.find_one({"rendition_of": content._id, "width": width, "format": name})
+  if rendition:
+    return rendition
+  try:
+    return create_rendition(content, width, name)
+  except OSError as exc:  # Pillow raises subclasses of OSError for undecodable data
+    print(f"Could not make rendition of {original._id}: {exc}")
+    return original
+
+
+# Make every missing rendition of an original GridFS file
+def create_renditions(original):
+  content = resolve_blob(original)
+  data = content.read()
+  try:
+    for width in RENDITION_WIDTHS:
+      for name in RENDITION_FORMATS:
+        if not fs.exists(rendition_of=content._id, width=width, format=name):
+          create_rendition(content, width, name, data)
+  except OSError as exc:
+    print(f"Could not make renditions of {original._id}: {exc}")
+
+
+# Renditions made on ingest are left to a job, so uploads do not wait for them
+@job_type("renditions", concurrency=2)
+def run_renditions(params: dict, progress):
+  try:
+    create_renditions(fs.get(params["id"]))
+  except NoFile:
+    pass  # Deleted in the meantime
+
+
+# Delete every rendition of the content of an original image
+def delete_renditions(_id):
+  for rendition in fs.find({"rendition_of": _id}):
+    fs.delete(rendition._id)
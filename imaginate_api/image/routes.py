@@ -1,28 +1,75 @@
-import base64
 from bson import ObjectId
-from flask import Blueprint, jsonify, make_response, render_template, request
-from imaginate_api.extensions import fs, db
+from flask import (
+  Blueprint,
+  abort,
+  current_app,
+  json,
+  jsonify,
+  render_template,
+  request,
+  stream_with_context,
+  url_for,
+)
+from imaginate_api.date.bundle import bundles
+from imaginate_api.date.latest import latest
+from imaginate_api.extensions import db
+from imaginate_api.image.cache import image_cache
+from imaginate_api.image.purge import purge_or_start, sweep_orphaned_chunks
+from imaginate_api.image.renditions import RENDITION_WIDTHS, get_requested_rendition
+from imaginate_api.image.storage import (
+  delete_stored_image,
+  fetch_image,
+  ingest_entries,
+  store_image,
+)
+from imaginate_api.image.verification import claim_images, update_statuses
+from imaginate_api.jobs import build_job_response, runner
 from image_handler_client.schemas.image_info import ImageStatus
 from imaginate_api.utils import (
   validate_id,
   search_id,
   build_result,
-  calculate_date,
-  build_image_from_url,
+  build_document_result,
+  build_file_response,
+  build_image_query,
+  get_page_limit,
+  IMAGE_PROJECTION,
+  normalize_url,
+  str_to_bool,
   validate_post_image_create_request,
 )
+from http import HTTPStatus
+from markupsafe import escape
+from urllib.parse import urlencode
 
 bp = Blueprint("image", __name__)
 
 
-# GET /read: used for viewing all images
+# GET /read: used for viewing all images, one page at a time ordered by ID (see limit and after)
 # This endpoint is simply for testing purposes
 @bp.route("/read")
 def read_all():
-  content = ""
-  for res in fs.find():
-    content += f'<li><a href="read/{res._id}">{res.filename} - {res._id}</a></li>\n'
-  return f"<ul>\n{content}</ul>"
+  limit = get_page_limit(request.args)
+  query = {"kind": {"$exists": False}}  # Skip renditions and blobs
+  if request.args.get("after"):
+    query["_id"] = {"$gt": validate_id(request.args["after"])}
+  cursor = db["fs.files"].find(query, {"filename": 1}).sort("_id", 1).limit(limit)
+
+  # The page is streamed as it is read from the cursor
+  def generate():
+    yield "<ul>\n"
+    count, last_id = 0, None
+    for document in cursor:
+      count, last_id = count + 1, document["_id"]
+      filename = escape(document.get("filename"))
+      yield f'<li><a href="read/{last_id}">{filename} - {last_id}</a></li>\n'
+    yield "</ul>\n"
+    if count == limit:
+      yield f'<a href="?{urlencode({"limit": limit, "after": last_id})}">Next</a>\n'
+
+  return current_app.response_class(
+    stream_with_context(generate()), mimetype="text/html"
+  )
 
 
 # POST /create: used for image population
@@ -34,7 +81,8 @@ def upload():
   )  # Determine if our request wants us to use a url
   if request_url:
     print("Getting file data through url attribute")
-    request_file = build_image_from_url(request_url)
+    request_url = normalize_url(request_url)
+    request_file = fetch_image(request_url)
   else:
     print("Getting file data through file attribute")
     request_file = request.files.get("file")
@@ -45,28 +93,69 @@ def upload():
     request.form.get("real"),
   )
   status = ImageStatus(request.form.get("status", ImageStatus.UNVERIFIED)).value
-  _id = fs.put(
-    file.stream.read(),
-    filename=file.filename,
-    type=file.content_type,
-    date=calculate_date(date),
-    theme=theme,
-    real=real,
-    status=status,
-  )
+  _id = store_image(file, date, theme, real, status, request_url)
   return jsonify(build_result(_id, real, date, theme, status, file.filename))
 
 
+# POST /create-bulk: used for populating many images at once
+# Accepts a JSON body {"images": [...]} whose entries match the form of POST /create, or the same list
+# as JSON in the "images" field of a multipart form, where an entry's "file" names the field of its upload
+# With background=true, entries are ingested by a job and its ID is returned right away
+@bp.route("/create-bulk", methods=["POST"])
+def upload_bulk():
+  if request.is_json:
+    entries = (request.get_json(silent=True) or {}).get("images")
+  else:
+    try:
+      entries = json.loads(request.form.get("images", "null"))
+    except ValueError:
+      entries = None
+  if not (
+    isinstance(entries, list)
+    and entries
+    and all(isinstance(entry, dict) for entry in entries)
+  ):
+    abort(HTTPStatus.BAD_REQUEST, description="Invalid schema")
+  max_items = current_app.config["BULK_CREATE_MAX_ITEMS"]
+  if len(entries) > max_items:
+    abort(
+      HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+      description=f"At most {max_items} images per request",
+    )
+
+  # Entries from URLs can be ingested by a background job, see jobs.py
+  if str_to_bool(request.args.get("background", "false")):
+    if any(entry.get("file") for entry in entries):
+      abort(
+        HTTPStatus.BAD_REQUEST,
+        description="Uploaded files cannot be ingested in the background",
+      )
+    return build_job_response(runner.submit("ingest", {"entries": entries}))
+
+  # Uploaded files are only accessible from the request thread
+  files = {
+    index: request.files.get(entry["file"])
+    for index, entry in enumerate(entries)
+    if entry.get("file")
+  }
+  results = ingest_entries(entries, files)
+  failed = any(result["code"] != HTTPStatus.OK for result in results)
+  return jsonify(results), HTTPStatus.MULTI_STATUS if failed else HTTPStatus.OK
+
+
 # GET /read/<id>: used for viewing a specific image
+# Optional parameters size (width in pixels) and format (webp or jpeg) ask for a smaller rendition instead
+# Hot images are served from memory, see image/cache.py
 @bp.route("/read/<id>")
 def read(id):
   _id = validate_id(id)
-  res = search_id(_id)
-
-  response = make_response(res.read())
-  response.headers.set("Content-Type", res.type)
-  response.headers.set("Content-Length", f"{res.length}")
-  return response
+  rendition = get_requested_rendition(request.args, request.accept_mimetypes)
+  if rendition:
+    response = build_file_response(image_cache.get_rendition(_id, *rendition))
+    if "format" not in request.args:
+      response.vary.add("Accept")
+    return response
+  return build_file_response(image_cache.get(_id))
 
 
 # GET /read/<id>: used for viewing a specific image
@@ -92,46 +181,105 @@ def delete_image(id):
   res_filename = getattr(res, "filename", None)
 
   info = build_result(res._id, res_real, res_date, res_theme, res_status, res_filename)
-  fs.delete(res._id)
+  delete_stored_image(res)
+  bundles.invalidate()
+  latest.discard(res_date)
   return jsonify(info)
 
 #Image Verification Routes
 
 @bp.route("/verification-portal", methods=["GET"])
 def verification_portal():
-    obj = db['fs.files'].find_one({'status': ImageStatus.UNVERIFIED.value})
-    print(obj)
-    if obj:
-        grid_out = fs.find_one({"_id":obj['_id']})
-        data = grid_out.read()
-        base64_data = base64.b64encode(data).decode('ascii')
-        return render_template('verification_portal.html', id=obj['_id'], img_found=True, img_src=base64_data, obj_data=obj)
+    _, _, images = claim_images(1, "verification-portal")
+    if images:
+        obj = images[0]
+        img_src = url_for('.read', id=str(obj['_id']))
+        return render_template('verification_portal.html', id=obj['_id'], img_found=True, img_src=img_src, obj_data=obj)
     return render_template('verification_portal.html', img_found=False)
 
-@bp.route("/all-images", methods=["GET"])
-def get_all_images():
+
+# POST /verification-queue: used for claiming a batch of unverified images to review
+# Optional JSON body: {"limit": N, "reviewer": name}, the claim expires after VERIFICATION_CLAIM_TTL seconds
+@bp.route("/verification-queue", methods=["POST"])
+def claim_verification_batch():
+  body = request.get_json(silent=True) or {}
+  max_batch = current_app.config["VERIFICATION_MAX_BATCH"]
+  try:
+    limit = int(body.get("limit", current_app.config["VERIFICATION_BATCH_SIZE"]))
+  except (TypeError, ValueError):
+    abort(HTTPStatus.BAD_REQUEST, description="Invalid limit")
+  if not 0 < limit <= max_batch:
+    abort(HTTPStatus.BAD_REQUEST, description=f"Limit should be in [1, {max_batch}]")
+
+  token, expires, documents = claim_images(limit, body.get("reviewer"))
+  images = []
+  for document in documents:
+    result = build_document_result(document)
+    result["thumbnail_url"] = f"{result['url']}?size={RENDITION_WIDTHS[0]}"
+    images.append(result)
+  return jsonify({"claim": token, "expires": expires.timestamp(), "images": images})
+
+
+# POST /update-status-bulk: used for setting the status of many images at once
+# JSON body: {"updates": [{"id": ..., "status": ...}, ...], "claim": token}, with a claim only images it holds are updated
+@bp.route("/update-status-bulk", methods=["POST"])
+def update_status_bulk():
+  body = request.get_json(silent=True) or {}
+  entries = body.get("updates")
+  if not (
+    isinstance(entries, list)
+    and entries
+    and all(isinstance(entry, dict) for entry in entries)
+  ):
+    abort(HTTPStatus.BAD_REQUEST, description="Invalid schema")
+  max_batch = current_app.config["VERIFICATION_MAX_BATCH"]
+  if len(entries) > max_batch:
+    abort(
+      HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+      description=f"At most {max_batch} updates per request",
+    )
+
+  updates = []
+  for entry in entries:
     try:
-        # Fetch all images from GridFS using an empty query
-        images = fs.find({})
+      status = ImageStatus(entry.get("status")).value
+    except ValueError:
+      abort(HTTPStatus.BAD_REQUEST, description="Invalid status")
+    updates.append((validate_id(entry.get("id")), status))
 
-        # Prepare a list to store image metadata
-        image_list = []
+  result = update_statuses(updates, body.get("claim"))
+  bundles.invalidate()
+  for _id, _ in updates:
+    image_cache.invalidate(_id)
+  return jsonify({"matched": result.matched_count, "modified": result.modified_count})
 
-        for image in images:
-            image_info = {
-                "filename": image.filename,
-                "date": image.date,
-                "theme": image.theme,
-                "real": image.real,
-                "status": image.status,
-            }
-            image_list.append(image_info)
+# GET /all-images: used for listing image metadata, one page at a time ordered by ID
+# Filters: date_from, date_to, theme, status, real; pages: limit and after (the cursor sent in X-Next-Cursor)
+# With format=ndjson every matching image is streamed instead, one JSON object per line
+@bp.route("/all-images", methods=["GET"])
+def get_all_images():
+  query = build_image_query(request.args)
+  if request.args.get("format") == "ndjson":
+    cursor = db["fs.files"].find(query, IMAGE_PROJECTION).sort("_id", 1)
+    lines = (json.dumps(build_document_result(document)) + "\n" for document in cursor)
+    return current_app.response_class(
+      stream_with_context(lines), mimetype="application/x-ndjson"
+    )
 
-        # Return the list of images in JSON format
-        return jsonify(image_list), 200
+  limit = get_page_limit(request.args)
+  if request.args.get("after"):
+    query["_id"] = {"$gt": validate_id(request.args["after"])}
+  documents = list(
+    db["fs.files"].find(query, IMAGE_PROJECTION).sort("_id", 1).limit(limit)
+  )
+  response = jsonify([build_document_result(document) for document in documents])
+  if len(documents) == limit:
+    next_cursor = str(documents[-1]["_id"])
+    next_url = url_for(".get_all_images", **{**request.args, "after": next_cursor})
+    response.headers["X-Next-Cursor"] = next_cursor
+    response.headers["Link"] = f'<{next_url}>; rel="next"'
+  return response
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
 
 @bp.route("/update-status", methods=["POST"])
 def update_status():
@@ -139,13 +287,27 @@ def update_status():
     if status:
         query_filter = { '_id': ObjectId(request.form['_id']) }
         update_operation = { "$set" : { "status" : status } }
-        db['fs.files'].find_one_and_update(query_filter, update_operation)
+        document = db['fs.files'].find_one_and_update(query_filter, update_operation)
+        if document:
+            bundles.invalidate()
+            image_cache.invalidate(document["_id"])
     else:
         return "new status not recieved",400  
     return "status updated",200
 
 @bp.route("/delete-rejected", methods=["DELETE"])
 def delete_rejected():
-    filter = {"status":"rejected"}
-    results = db["fs.files"].delete_many(filter)
-    return results, 200
+  counts, job_id = purge_or_start(
+    {"status": ImageStatus.REJECTED.value},
+    dry_run=str_to_bool(request.args.get("dry_run", "false")),
+    background=str_to_bool(request.args.get("background", "false")),
+  )
+  if job_id:
+    return build_job_response(job_id)
+  return jsonify({"deleted": counts["images"], **counts}), HTTPStatus.OK
+
+
+@bp.route("/sweep-orphaned-chunks", methods=["POST"])
+def sweep_orphaned():
+  dry_run = str_to_bool(request.args.get("dry_run", "false"))
+  return jsonify(sweep_orphaned_chunks(dry_run))
@@ -0,0 +1,205 @@
+from bson.objectid import ObjectId
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import abort, current_app
+from gridfs.errors import FileExists
+from image_handler_client.schemas.image_info import ImageStatus
+from imaginate_api.date.bundle import bundles
+from imaginate_api.date.latest import latest
+from imaginate_api.extensions import fs, db
+from imaginate_api.image.cache import image_cache
+from imaginate_api.image.renditions import delete_renditions
+from imaginate_api.jobs import job_type, runner
+from imaginate_api.utils import (
+  build_result,
+  calculate_date,
+  build_image_from_url,
+  normalize_url,
+  resolve_blob,
+  validate_post_image_create_request,
+)
+from http import HTTPStatus
+from io import BytesIO
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import HTTPException
+import hashlib
+
+# Explanation of deduplication:
+# - Content is addressed by its SHA-256, the first image storing some content owns its chunks and counts its references ("refs")
+# - Storing the same content again only adds an image without chunks, pointing at the owner through "blob_id"
+# - Deleting an image drops a reference and the content goes with the last one, an owner deleted before that is
+#   stripped of its image metadata and kept as a hidden blob (kind "blob")
+# - Source URLs are normalized and kept as "source_url", so a URL that was ingested before is not downloaded again
+
+BLOB_KIND = "blob"
+
+# Update turning an owner into a hidden blob, when it is deleted while other images still use its content
+BLOB_UPDATE = {
+  "$set": {"kind": BLOB_KIND},
+  "$unset": {"date": "", "theme": "", "real": "", "status": ""},
+}
+
+
+# Attempts at storing an image, each one is lost to a concurrent store or deletion of the same content
+STORE_ATTEMPTS = 3
+
+
+# Helper function to add a reference to stored content, returning the ID of its owner or None if it is not stored
+# Content left without references (by a deletion that was interrupted) is deleted, so that it can be stored again
+def acquire_blob(sha256: str):
+  files = db["fs.files"]
+  document = files.find_one_and_update(
+    {"sha256": sha256, "refs": {"$gt": 0}},
+    {"$inc": {"refs": 1}},
+    projection={"_id": 1},
+  )
+  if document:
+    return document["_id"]
+  for document in files.find({"sha256": sha256, "refs": {"$lte": 0}}, {"_id": 1}):
+    fs.delete(document["_id"])
+    delete_renditions(document["_id"])
+  return None
+
+
+# Helper function to drop a reference to stored content, deleting the content (and its renditions) with the last one
+# Any update is applied to the owner when it is kept, returns whether the content was deleted
+def release_blob(blob_id, update: dict | None = None):
+  files = db["fs.files"]
+  while files.find_one({"_id": blob_id}, {"_id": 1}):
+    if files.find_one_and_update(
+      {"_id": blob_id, "refs": {"$gt": 1}},
+      {"$inc": {"refs": -1}, **(update or {})},
+    ):
+      return False
+    # Zero the count before deleting, so the content cannot be acquired meanwhile (images stored before
+    # deduplication have no count)
+    zeroed = files.update_one(
+      {"_id": blob_id, "refs": {"$not": {"$gt": 1}}}, {"$set": {"refs": 0}}
+    )
+    if zeroed.matched_count:
+      fs.delete(blob_id)
+      delete_renditions(blob_id)
+      return True
+  return False
+
+
+# Delete a stored image, its content is only deleted with the last image using it
+def delete_stored_image(grid_out):
+  if getattr(grid_out, "kind", None) is not None:  # Already deleted, or a rendition
+    abort(HTTPStatus.NOT_FOUND, description="Image not found")
+  image_cache.invalidate(grid_out._id)
+  blob_id = getattr(grid_out, "blob_id", None)
+  if blob_id is None:
+    return release_blob(grid_out._id, BLOB_UPDATE)
+  fs.delete(grid_out._id)
+  return release_blob(blob_id)
+
+
+# Helper function to get the image at a URL, reusing the content of an image stored from the same URL
+def fetch_image(url: str):
+  document = fs.find_one({"source_url": url})
+  if document is None:
+    return build_image_from_url(url)
+  print("Reusing content of image with the same URL")
+  return FileStorage(
+    stream=BytesIO(resolve_blob(document).read()),
+    filename=document.filename,
+    content_type=document.type,
+  )
+
+
+# Store a validated image and refresh the caches of its date, returning its ID
+# Content that is already stored is reused rather than written again
+def store_image(
+  file, date: int, theme: str, real: bool, status: str, source_url: str | None = None
+):
+  timestamp = calculate_date(date)
+  data = file.stream.read()
+  sha256 = hashlib.sha256(data).hexdigest()
+  metadata = {
+    "filename": file.filename,
+    "type": file.content_type,
+    "date": timestamp,
+    "theme": theme,
+    "real": real,
+    "status": status,
+  }
+  if source_url:
+    metadata["source_url"] = source_url
+
+  for _ in range(STORE_ATTEMPTS):
+    blob_id = acquire_blob(sha256)
+    if blob_id is not None:
+      try:
+        _id = fs.put(b"", blob_id=blob_id, **metadata)
+      except Exception:
+        release_blob(blob_id)
+        raise
+      break
+    _id = ObjectId()
+    try:
+      fs.put(data, _id=_id, sha256=sha256, refs=1, **metadata)
+      break
+    except FileExists:  # The same content was stored concurrently, reference it instead
+      fs.delete(_id)
+  else:
+    abort(
+      HTTPStatus.SERVICE_UNAVAILABLE,
+      description="Image is being stored concurrently, try again",
+    )
+
+  bundles.invalidate()
+  latest.bump(timestamp)
+  if current_app.config["RENDITIONS_ON_INGEST"]:
+    runner.submit("renditions", {"id": _id})
+  return _id
+
+
+# Helper function to download (if needed), validate and store a single bulk entry
+# Returns the result of the entry rather than raising, so one bad entry does not fail the batch
+def ingest_entry(app, index: int, entry: dict, file=None):
+  with app.app_context():
+    try:
+      source_url = None
+      if entry.get("url"):
+        source_url = normalize_url(entry["url"])
+        file = fetch_image(source_url)
+      real = entry.get("real")
+      file, date, theme, real = validate_post_image_create_request(
+        file,
+        entry.get("date"),
+        entry.get("theme"),
+        None if real is None else str(real),
+      )
+      try:
+        status = ImageStatus(entry.get("status", ImageStatus.UNVERIFIED)).value
+      except ValueError:
+        abort(HTTPStatus.BAD_REQUEST, description="Invalid status")
+      _id = store_image(file, date, theme, real, status, source_url)
+      result = build_result(_id, real, date, theme, status, file.filename)
+      return {"index": index, "code": HTTPStatus.OK, "result": result}
+    except HTTPException as exc:
+      return {"index": index, "code": exc.code, "description": exc.description}
+
+
+# Ingest many entries concurrently through a bounded worker pool, downloads share the pooled outbound client
+# Each entry is a dictionary like the form of POST /image/create, files are given separately by index
+# Progress, when given, is called with the number of entries done so far
+def ingest_entries(entries: list[dict], files: dict | None = None, progress=None):
+  app = current_app._get_current_object()
+  files = files or {}
+  workers = max(1, min(app.config["BULK_CREATE_WORKERS"], len(entries)))
+  with ThreadPoolExecutor(workers) as executor:
+    futures = [
+      executor.submit(ingest_entry, app, index, entry, files.get(index))
+      for index, entry in enumerate(entries)
+    ]
+    if progress is not None:
+      for done, _ in enumerate(as_completed(futures), 1):
+        progress({"done": done, "total": len(entries)})
+    return [future.result() for future in futures]
+
+
+# Entries are not ingested twice, a failed ingest would store the entries that succeeded again
+@job_type("ingest", max_attempts=1)
+def run_ingest(params: dict, progress):
+  return ingest_entries(params["entries"], progress=progress)
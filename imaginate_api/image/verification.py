@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from image_handler_client.schemas.image_info import ImageStatus
+from imaginate_api.extensions import db
+from imaginate_api.utils import IMAGE_PROJECTION
+from pymongo import UpdateOne
+import secrets
+
+# Explanation of the verification queue:
+# - Reviewers claim batches of unverified images, a claim lasts VERIFICATION_CLAIM_TTL seconds
+# - A claim marks images with claimed_by, claim_token and claimed_until in one update_many whose filter skips images
+#   with a live claim, so concurrent reviewers never get the same image
+# - Statuses of a batch are written with one bulk_write, which also releases the claims of the updated images
+
+# Attempts at filling a batch when concurrent reviewers claim some of its candidates first
+CLAIM_ATTEMPTS = 3
+
+CLAIM_FIELDS = {"claimed_by": "", "claim_token": "", "claimed_until": ""}
+
+
+# Helper function to get the filter of unverified images without a live claim
+def get_unclaimed_filter(now: datetime):
+  return {
+    "status": ImageStatus.UNVERIFIED.value,
+    "kind": {"$exists": False},
+    "claimed_until": {"$not": {"$gt": now}},
+  }
+
+
+# Claim up to limit unverified images for a reviewer, oldest first
+# Returns the claim token, its expiry and the claimed image documents
+def claim_images(limit: int, reviewer: str | None = None):
+  files = db["fs.files"]
+  now = datetime.now(timezone.utc)
+  token = secrets.token_hex(16)
+  expires = now + timedelta(seconds=current_app.config["VERIFICATION_CLAIM_TTL"])
+  claim = {"claimed_by": reviewer, "claim_token": token, "claimed_until": expires}
+
+  claimed = []
+  for _ in range(CLAIM_ATTEMPTS):
+    unclaimed = get_unclaimed_filter(now)
+    candidates = [
+      document["_id"]
+      for document in files.find(unclaimed, {"_id": 1})
+      .sort("_id", 1)
+      .limit(limit - len(claimed))
+    ]
+    if not candidates:
+      break
+    files.update_many({**unclaimed, "_id": {"$in": candidates}}, {"$set": claim})
+    claimed = list(files.find({"claim_token": token}, IMAGE_PROJECTION).sort("_id", 1))
+    if len(claimed) >= limit:
+      break
+  return token, expires, claimed
+
+
+# Write the statuses of many images at once, as (ID, status) pairs
+# With a claim token, only images still claimed with it are updated
+def update_statuses(updates: list[tuple], token: str | None = None):
+  operations = []
+  for _id, status in updates:
+    query = {"_id": _id, "kind": {"$exists": False}}  # Never renditions or blobs
+    if token:
+      query["claim_token"] = token
+    operations.append(
+      UpdateOne(query, {"$set": {"status": status}, "$unset": CLAIM_FIELDS})
+    )
+  return db["fs.files"].bulk_write(operations, ordered=False)
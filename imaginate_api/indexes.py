@@ -0,0 +1,227 @@
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from bson.objectid import ObjectId
+from imaginate_api.config import Config
+from imaginate_api.date.schedule import get_assignable_filter
+from imaginate_api.extensions import db
+from pymongo.errors import OperationFailure
+import click
+import sys
+
+# Indexes required by the queries of each collection, keyed by collection name
+# NOTE: The (date, status) index also serves queries and sorts on date alone
+INDEXES = {
+  "fs.files": [
+    IndexModel([("date", ASCENDING), ("status", ASCENDING)], name="date_status"),
+    IndexModel([("status", ASCENDING)], name="status"),
+    IndexModel(
+      [("rendition_of", ASCENDING), ("width", ASCENDING), ("format", ASCENDING)],
+      name="rendition",
+      sparse=True,
+    ),
+    # Content hashes of deduplicated images, unique so that content is only stored once
+    IndexModel([("sha256", ASCENDING)], name="sha256", unique=True, sparse=True),
+    IndexModel([("source_url", ASCENDING)], name="source_url", sparse=True),
+    IndexModel([("claim_token", ASCENDING)], name="claim_token", sparse=True),
+  ],
+  # GridFS creates this index itself on the first write, declaring it covers fresh databases
+  "fs.chunks": [
+    IndexModel([("files_id", ASCENDING), ("n", ASCENDING)], unique=True),
+  ],
+  "days": [
+    IndexModel([("day", ASCENDING)], name="day"),
+    IndexModel([("appearances", ASCENDING)], name="appearances"),
+  ],
+  # Unique so that concurrent first logins create one user (see schemas/user_info.py), users without a value are left out
+  "users": [
+    IndexModel(
+      [("email", ASCENDING)],
+      name="email_unique",
+      unique=True,
+      partialFilterExpression={"email": {"$type": "string"}},
+    ),
+    *[
+      IndexModel(
+        [(f"{provider}_id", ASCENDING)],
+        name=f"{provider}_id_unique",
+        unique=True,
+        partialFilterExpression={f"{provider}_id": {"$type": "string"}},
+      )
+      for provider in Config.AUTH_PROVIDERS
+    ],
+  ],
+  "jobs": [
+    IndexModel([("state", ASCENDING), ("updated", ASCENDING)], name="state_updated"),
+    IndexModel([("type", ASCENDING)], name="type"),
+  ],
+}
+
+# Every query shape issued by the API, as (description, collection name, filter, sort)
+# Values are placeholders, only the shape matters to the query planner
+QUERY_SHAPES = [
+  ("latest date", "fs.files", {}, [("date", DESCENDING)]),
+  ("images by id", "fs.files", {"_id": {"$in": [ObjectId()]}}, None),
+  ("images by status", "fs.files", {"status": "unverified"}, None),
+  ("images by date and status", "fs.files", {"date": 0, "status": "rejected"}, None),
+  (
+    "rendition of image",
+    "fs.files",
+    {"rendition_of": ObjectId(), "width": 320, "format": "webp"},
+    None,
+  ),
+  ("content by hash", "fs.files", {"sha256": "", "refs": {"$gt": 0}}, None),
+  (
+    "unreferenced content by hash",
+    "fs.files",
+    {"sha256": "", "refs": {"$lte": 0}},
+    None,
+  ),
+  ("renditions of image", "fs.files", {"rendition_of": ObjectId()}, None),
+  ("renditions of images", "fs.files", {"rendition_of": {"$in": [ObjectId()]}}, None),
+  ("images listing", "fs.files", {"kind": {"$exists": False}}, [("_id", ASCENDING)]),
+  (
+    "images of a day",
+    "fs.files",
+    {"_id": {"$in": [ObjectId()]}, "kind": {"$exists": False}},
+    None,
+  ),
+  ("image by source URL", "fs.files", {"source_url": ""}, None),
+  ("images by claim", "fs.files", {"claim_token": ""}, [("_id", ASCENDING)]),
+  ("day by day", "days", {"day": 0}, None),
+  ("day by id", "days", {"_id": 0}, None),
+  ("assignable days", "days", get_assignable_filter(0), None),
+  ("user by id", "users", {"_id": ObjectId()}, None),
+  ("user by email", "users", {"email": ""}, None),
+  *[
+    (f"user by {provider} id", "users", {f"{provider}_id": ""}, None)
+    for provider in Config.AUTH_PROVIDERS
+  ],
+  ("jobs by state", "jobs", {"state": "queued"}, [("_id", ASCENDING)]),
+  ("stale jobs", "jobs", {"state": "running", "updated": {"$lt": 0}}, None),
+  ("jobs by type", "jobs", {"type": "purge"}, [("_id", DESCENDING)]),
+]
+
+
+# Errors of indexes existing with the same name or keys but other options
+INDEX_CONFLICT_CODES = {85, 86}  # IndexOptionsConflict, IndexKeySpecsConflict
+
+
+# Helper function to get the keys of an index from index_information, as (field, direction) pairs
+def get_index_keys(information: dict):
+  return [tuple(key) for key in information["key"]]
+
+
+# Helper function to get the existing indexes on the same keys as an index, other than the declared ones
+def get_superseded_indexes(collection, index: IndexModel):
+  declared = {model.document["name"] for model in INDEXES.get(collection.name, [])}
+  keys = list(index.document["key"].items())
+  return {
+    name: information
+    for name, information in collection.index_information().items()
+    if name not in declared and get_index_keys(information) == keys
+  }
+
+
+# Helper function to replace the existing indexes conflicting with an index by it, when they cannot coexist
+# The dropped indexes are created again if the index cannot be created (e.g. its unique values are duplicated)
+def replace_index(collection, index: IndexModel):
+  name = index.document["name"]
+  conflicting = get_superseded_indexes(collection, index)
+  if name in collection.index_information():
+    conflicting[name] = collection.index_information()[name]
+  for conflicting_name in conflicting:
+    collection.drop_index(conflicting_name)
+  try:
+    return collection.create_indexes([index])
+  except OperationFailure as exc:
+    for conflicting_name, information in conflicting.items():
+      options = {
+        key: value
+        for key, value in information.items()
+        if key not in ["key", "v", "ns"]
+      }
+      collection.create_index(
+        get_index_keys(information), name=conflicting_name, **options
+      )
+    print(
+      f'Could not create index "{name}" on "{collection.name}", kept the previous ones: {exc}',
+      file=sys.stderr,
+    )
+    return []
+
+
+# Helper function to create an index, then drop the older indexes on the same keys it supersedes
+# Failures are logged rather than raised so the app still starts, queries then use the previous indexes
+def ensure_index(collection, index: IndexModel):
+  name = index.document["name"]
+  try:
+    created = collection.create_indexes([index])
+  except OperationFailure as exc:
+    if exc.code not in INDEX_CONFLICT_CODES:
+      print(
+        f'Could not create index "{name}" on "{collection.name}": {exc}',
+        file=sys.stderr,
+      )
+      return []
+    return replace_index(collection, index)
+  for superseded in get_superseded_indexes(collection, index):
+    collection.drop_index(superseded)
+    print(
+      f'Dropped index "{superseded}" on "{collection.name}", superseded by "{name}"'
+    )
+  return created
+
+
+# Create any missing index, this is idempotent so it is safe to run on every startup
+# Indexes whose declaration changed (e.g. becoming unique, under a new name) replace the previous ones
+def ensure_indexes(db=db):
+  for collection_name, indexes in INDEXES.items():
+    collection = db[collection_name]
+    created = []
+    for index in indexes:
+      created += ensure_index(collection, index)
+    print(f'Ensured indexes on "{collection_name}": {created}')
+
+
+# Helper function to collect every stage name of an explained query plan
+# Plans of the slot based engine nest the classic plan under "queryPlan"
+def get_plan_stages(plan: dict):
+  stages = [plan["stage"]] if "stage" in plan else []
+  for child in [
+    plan.get("queryPlan"),
+    plan.get("inputStage"),
+    *plan.get("inputStages", []),
+  ]:
+    if child:
+      stages += get_plan_stages(child)
+  return stages
+
+
+# Explain every query shape and return (description, stages, is_collscan) for each
+def check_query_plans(db=db):
+  results = []
+  for description, collection_name, query, sort in QUERY_SHAPES:
+    cursor = db[collection_name].find(query).limit(1)
+    if sort:
+      cursor = cursor.sort(sort)
+    stages = get_plan_stages(cursor.explain()["queryPlanner"]["winningPlan"])
+    results.append((description, stages, "COLLSCAN" in stages))
+  return results
+
+
+# CLI: flask --app imaginate_api.app ensure-indexes
+@click.command("ensure-indexes")
+def ensure_indexes_command():
+  ensure_indexes()
+
+
+# CLI: flask --app imaginate_api.app check-query-plans
+@click.command("check-query-plans")
+def check_query_plans_command():
+  collscans = 0
+  for description, stages, is_collscan in check_query_plans():
+    collscans += is_collscan
+    flag = "COLLSCAN" if is_collscan else "ok"
+    print(f"{flag:<8} {description}: {' <- '.join(stages)}")
+  if collscans:
+    print(f"{collscans} query shape(s) fall back to a collection scan", file=sys.stderr)
+    sys.exit(1)
@@ -0,0 +1,39 @@
+from flask import Blueprint, abort, jsonify, request
+from imaginate_api.extensions import db
+from imaginate_api.utils import get_page_limit, validate_id
+from http import HTTPStatus
+
+bp = Blueprint("job", __name__)
+
+
+# Helper function to build the result of a job document, leaving out its parameters
+def build_job_result(job: dict):
+  return {
+    "id": str(job["_id"]),
+    "type": job["type"],
+    "state": job["state"],
+    "attempts": job["attempts"],
+    "progress": job.get("progress") or {},
+    "result": job.get("result"),
+    "error": job.get("error"),
+    "created": job["created"],
+    "updated": job["updated"],
+  }
+
+
+# GET /: used for viewing the latest jobs, optionally filtered by state and type (see limit)
+@bp.route("/")
+def get_jobs():
+  query = {key: request.args[key] for key in ["state", "type"] if key in request.args}
+  limit = get_page_limit(request.args)
+  jobs = db["jobs"].find(query).sort("_id", -1).limit(limit)
+  return jsonify([build_job_result(job) for job in jobs])
+
+
+# GET /<id>: used for following the progress of a job
+@bp.route("/<id>")
+def get_job(id):
+  job = db["jobs"].find_one({"_id": validate_id(id)})
+  if job is None:
+    abort(HTTPStatus.NOT_FOUND, description="Job not found")
+  return jsonify(build_job_result(job))
@@ -0,0 +1,300 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from flask import current_app, jsonify, url_for
+from http import HTTPStatus
+from imaginate_api.extensions import db
+from pymongo import ReturnDocument
+from werkzeug.exceptions import HTTPException
+import os
+import threading
+import time
+
+# Explanation of background jobs:
+# - Heavy work (bulk ingests, purges, renditions) runs as jobs, endpoints enqueue one and answer with its ID right away
+# - Jobs are persisted in the "jobs" collection with their type, parameters, state, progress, result and attempts, so
+#   GET /jobs/<id> reports them from any worker process
+# - Each process runs jobs in a pool of JOB_WORKERS threads, a job type can limit how many of its jobs run at once
+# - A job failing with a server error is retried up to its maximum attempts (JOB_MAX_ATTEMPTS by default), waiting
+#   JOB_RETRY_BACKOFF seconds doubled on each attempt, client errors (4xx) fail at once
+# - The runner of a process starts with its first request, taking over queued jobs and running jobs whose last
+#   update is older than JOB_STALE_SECONDS (their process died), a job is claimed atomically so it only runs once
+# - An interrupted job counts as an attempt, a job claimed after its last attempt fails instead of running again
+# - A stopping worker (see server.py) waits for its running jobs, those still running when it exits are handed back
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Registered job types, name -> (function, concurrency, max attempts)
+# A job function is called with the parameters of the job and a function reporting its progress, in an app context
+JOB_TYPES = {}
+
+
+# Register a job type, concurrency limits the jobs of this type running at once in a process (None for no limit)
+def job_type(
+  name: str, concurrency: int | None = None, max_attempts: int | None = None
+):
+  def register(function):
+    JOB_TYPES[name] = (function, concurrency, max_attempts)
+    return function
+
+  return register
+
+
+# Helper function to get the current time as stored in job documents
+def get_now():
+  return datetime.now(timezone.utc)
+
+
+# Helper function to get the maximum attempts of a job type
+def get_max_attempts(name: str, config):
+  return JOB_TYPES[name][2] or config["JOB_MAX_ATTEMPTS"]
+
+
+class JobRunner:
+  def __init__(self):
+    self._executor = None
+    self._pid = None
+    self._app = None
+    self._pending = {}  # Job type -> queue of (app, job ID)
+    self._running = {}  # Job type -> number of running jobs
+    self._claimed = {}  # Job ID -> job type, of the jobs claimed by this process
+    self._stopping = False
+    self._lock = threading.Lock()
+
+  # Start the worker pool of the current process and take over its share of unfinished jobs
+  # The pool is created again in a forked process, like the MongoDB client (see extensions.py)
+  def start(self, app):
+    if self._executor is not None and self._pid == os.getpid():
+      return
+    with self._lock:
+      if self._executor is not None and self._pid == os.getpid():
+        return
+      self._executor = ThreadPoolExecutor(
+        app.config["JOB_WORKERS"], thread_name_prefix="job"
+      )
+      self._pid = os.getpid()
+      self._app = app
+      self._pending = {}
+      self._running = {}
+      self._claimed = {}
+      self._stopping = False
+    self.recover(app)
+
+  # Stop running jobs in this process, waiting up to timeout for the running ones then handing back the others
+  # Jobs queued in this process stay queued in the collection, for the next runner to start
+  def stop(self, timeout: float):
+    with self._lock:
+      if self._executor is None or self._pid != os.getpid():
+        return
+      executor = self._executor
+      self._stopping = True
+      self._pending = {}
+    executor.shutdown(wait=False, cancel_futures=True)
+    deadline = time.time() + timeout
+    while self._claimed and time.time() < deadline:
+      time.sleep(0.1)
+    with self._lock:
+      claimed = dict(self._claimed)
+      self._executor = None
+    for job_id, name in claimed.items():
+      self._hand_back(job_id, name)
+
+  # Helper function to release a job this process cannot finish, failing it if that was its last attempt
+  def _hand_back(self, job_id, name: str):
+    jobs = db["jobs"]
+    job = jobs.find_one({"_id": job_id, "state": RUNNING}, {"attempts": 1})
+    if job is None:
+      return
+    if job["attempts"] >= get_max_attempts(name, self._app.config):
+      update = {"state": FAILED, "error": "Interrupted on its last attempt"}
+    else:
+      update = {"state": QUEUED}
+    jobs.update_one(
+      {"_id": job_id, "state": RUNNING}, {"$set": {**update, "updated": get_now()}}
+    )
+    print(f"Job {job_id} was interrupted, now {update['state']}")
+
+  # Requeue jobs whose process died and enqueue every queued job
+  def recover(self, app):
+    jobs = db["jobs"]
+    stale = get_now() - timedelta(seconds=app.config["JOB_STALE_SECONDS"])
+    jobs.update_many(
+      {"state": RUNNING, "updated": {"$lt": stale}},
+      {"$set": {"state": QUEUED, "updated": get_now()}},
+    )
+    recovered = 0
+    for job in jobs.find({"state": QUEUED}, {"type": 1, "retry_at": 1}).sort("_id", 1):
+      if job["type"] in JOB_TYPES:
+        self._schedule(app, job["_id"], job["type"], job.get("retry_at"))
+        recovered += 1
+    if recovered:
+      print(f"Recovered {recovered} queued jobs")
+
+  # Persist a new job and queue it, returning its ID
+  def submit(self, name: str, params: dict | None = None):
+    if name not in JOB_TYPES:
+      raise ValueError(f'Unknown job type "{name}"')
+    app = current_app._get_current_object()
+    self.start(app)
+    now = get_now()
+    job_id = (
+      db["jobs"]
+      .insert_one(
+        {
+          "type": name,
+          "params": params or {},
+          "state": QUEUED,
+          "attempts": 0,
+          "progress": {},
+          "result": None,
+          "error": None,
+          "created": now,
+          "updated": now,
+        }
+      )
+      .inserted_id
+    )
+    self._enqueue(app, job_id, name)
+    return job_id
+
+  # Helper function to queue a job in this process, once its retry time (if any) has come
+  def _schedule(self, app, job_id, name: str, retry_at: datetime | None = None):
+    delay = 0
+    if retry_at is not None:
+      if retry_at.tzinfo is None:  # Dates are read back naive from MongoDB
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+      delay = (retry_at - get_now()).total_seconds()
+    if delay <= 0:
+      self._enqueue(app, job_id, name)
+      return
+    timer = threading.Timer(delay, self._enqueue, (app, job_id, name))
+    timer.daemon = True
+    timer.start()
+
+  # Helper function to queue a job in this process
+  def _enqueue(self, app, job_id, name: str):
+    with self._lock:
+      if self._stopping:
+        return  # The job stays queued in the collection
+      self._pending.setdefault(name, deque()).append((app, job_id))
+      self._dispatch()
+
+  # Helper function to hand queued jobs to the pool within the concurrency of their type, the lock must be held
+  def _dispatch(self):
+    for name in list(self._pending):
+      pending = self._pending[name]
+      concurrency = JOB_TYPES[name][1]
+      while pending and (
+        concurrency is None or self._running.get(name, 0) < concurrency
+      ):
+        app, job_id = pending.popleft()
+        self._running[name] = self._running.get(name, 0) + 1
+        self._executor.submit(self._run, app, job_id, name, self._executor)
+      if not pending:
+        del self._pending[name]
+
+  # Helper function to run a job from the pool, then let the next job of its type run
+  # Nothing is dispatched once the pool was replaced, by stop and a new start
+  def _run(self, app, job_id, name: str, executor):
+    try:
+      with app.app_context():
+        self.run_job(job_id)
+    except Exception as exc:
+      print(f"Job {job_id} could not run: {exc}")
+    finally:
+      with self._lock:
+        if executor is self._executor:
+          self._running[name] -= 1
+          self._dispatch()
+
+  # Claim and run a job, unless another thread or process claimed it first
+  def run_job(self, job_id):
+    jobs = db["jobs"]
+    job = jobs.find_one_and_update(
+      {"_id": job_id, "state": QUEUED},
+      {"$set": {"state": RUNNING, "updated": get_now()}, "$inc": {"attempts": 1}},
+      return_document=ReturnDocument.AFTER,
+    )
+    if job is None:
+      return
+    if job["attempts"] > get_max_attempts(job["type"], current_app.config):
+      # Its last attempt was interrupted (see recover and stop), it must not run again
+      jobs.update_one(
+        {"_id": job_id},
+        {
+          "$set": {
+            "state": FAILED,
+            "error": "Interrupted on its last attempt",
+            "updated": get_now(),
+          }
+        },
+      )
+      return
+    function = JOB_TYPES[job["type"]][0]
+
+    def progress(fields: dict):
+      jobs.update_one(
+        {"_id": job_id}, {"$set": {"progress": fields, "updated": get_now()}}
+      )
+
+    with self._lock:
+      self._claimed[job_id] = job["type"]
+    try:
+      try:
+        result = function(job["params"], progress)
+      except Exception as exc:
+        self._fail(job, exc)
+        return
+      jobs.update_one(
+        {"_id": job_id},
+        {
+          "$set": {
+            "state": DONE,
+            "result": result,
+            "error": None,
+            "updated": get_now(),
+          }
+        },
+      )
+    finally:
+      with self._lock:
+        self._claimed.pop(job_id, None)
+
+  # Helper function to record the failure of a job, scheduling its retry when it is worth one
+  def _fail(self, job: dict, exc: Exception):
+    config = current_app.config
+    if isinstance(exc, HTTPException):
+      error, retry = exc.description, exc.code >= 500
+    else:
+      error, retry = str(exc) or type(exc).__name__, True
+    max_attempts = get_max_attempts(job["type"], config)
+    print(f"Job {job['_id']} failed on attempt {job['attempts']}: {error}")
+
+    update = {"error": error, "updated": get_now()}
+    if not retry or job["attempts"] >= max_attempts:
+      db["jobs"].update_one({"_id": job["_id"]}, {"$set": {"state": FAILED, **update}})
+      return
+    delay = config["JOB_RETRY_BACKOFF"] * 2 ** (job["attempts"] - 1)
+    retry_at = get_now() + timedelta(seconds=delay)
+    db["jobs"].update_one(
+      {"_id": job["_id"]},
+      {"$set": {"state": QUEUED, "retry_at": retry_at, **update}},
+    )
+    self._schedule(current_app._get_current_object(), job["_id"], job["type"], retry_at)
+
+
+runner = JobRunner()
+
+
+# Helper function to build the response of an endpoint that started a job
+def build_job_response(job_id):
+  return jsonify(
+    {"id": str(job_id), "status_url": url_for("job.get_job", id=str(job_id))}
+  ), HTTPStatus.ACCEPTED
+
+
+def init_app(app):
+  app.before_request(lambda: runner.start(app))
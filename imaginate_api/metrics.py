@@ -0,0 +1,224 @@
+from bisect import bisect_left
+from flask import Response, g, has_request_context, request
+from pymongo import monitoring
+import threading
+import time
+
+# Explanation of metrics:
+# - Every request records its latency, response size and status code by blueprint and endpoint
+# - A pymongo command listener (see extensions.py) times every MongoDB command by collection and command name, and
+#   counts the commands and time spent in MongoDB by each request
+# - GET /metrics exposes them in the Prometheus text format, along with the stats of the caches
+# - Metrics are kept in the memory of each process, with several workers (see server.py) a scrape sees one of them
+
+# Upper bounds of histogram buckets, in seconds for durations
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+SIZE_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216]
+COUNT_BUCKETS = [0, 1, 2, 3, 5, 10, 25, 50, 100]
+
+
+# Helper function to format the labels of a sample
+def format_labels(names, values):
+  if not names:
+    return ""
+  pairs = []
+  for name, value in zip(names, values):
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    pairs.append(f'{name}="{value}"')
+  return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+  def __init__(self, name: str, description: str, labels=()):
+    self.name = name
+    self.description = description
+    self.labels = tuple(labels)
+    self._values = {}  # Label values -> count
+    self._lock = threading.Lock()
+
+  def inc(self, *label_values, amount: float = 1):
+    with self._lock:
+      self._values[label_values] = self._values.get(label_values, 0) + amount
+
+  def render(self):
+    lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+    with self._lock:
+      for label_values, value in sorted(self._values.items()):
+        lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+    return lines
+
+
+class Histogram:
+  def __init__(self, name: str, description: str, labels=(), buckets=LATENCY_BUCKETS):
+    self.name = name
+    self.description = description
+    self.labels = tuple(labels)
+    self.buckets = list(buckets)
+    self._series = {}  # Label values -> [count per bucket (the last one is +Inf), sum]
+    self._lock = threading.Lock()
+
+  def observe(self, value: float, *label_values):
+    with self._lock:
+      series = self._series.get(label_values)
+      if series is None:
+        series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0]
+      series[0][bisect_left(self.buckets, value)] += 1
+      series[1] += value
+
+  def render(self):
+    lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+    labels = self.labels + ("le",)
+    with self._lock:
+      for label_values, (counts, total) in sorted(self._series.items()):
+        cumulative = 0
+        for bound, count in zip([*self.buckets, "+Inf"], counts):
+          cumulative += count
+          bucket_labels = format_labels(labels, (*label_values, bound))
+          lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+        sample_labels = format_labels(self.labels, label_values)
+        lines.append(f"{self.name}_sum{sample_labels} {total}")
+        lines.append(f"{self.name}_count{sample_labels} {cumulative}")
+    return lines
+
+
+REQUEST_LABELS = ("blueprint", "endpoint", "method", "status")
+request_duration = Histogram(
+  "http_request_duration_seconds", "Latency of requests.", REQUEST_LABELS
+)
+response_size = Histogram(
+  "http_response_size_bytes",
+  "Size of response bodies, unknown for streamed responses.",
+  ("blueprint", "endpoint"),
+  SIZE_BUCKETS,
+)
+request_mongodb_commands = Histogram(
+  "http_request_mongodb_commands",
+  "MongoDB commands issued by requests.",
+  ("blueprint", "endpoint"),
+  COUNT_BUCKETS,
+)
+request_mongodb_duration = Histogram(
+  "http_request_mongodb_duration_seconds",
+  "Time requests spent waiting on MongoDB.",
+  ("blueprint", "endpoint"),
+)
+mongodb_command_duration = Histogram(
+  "mongodb_command_duration_seconds",
+  "Latency of MongoDB commands.",
+  ("collection", "command"),
+)
+mongodb_command_failures = Counter(
+  "mongodb_command_failures_total",
+  "MongoDB commands that failed.",
+  ("collection", "command"),
+)
+METRICS = [
+  request_duration,
+  response_size,
+  request_mongodb_commands,
+  request_mongodb_duration,
+  mongodb_command_duration,
+  mongodb_command_failures,
+]
+
+
+# Times MongoDB commands, register with the event_listeners option of MongoClient
+class CommandTimer(monitoring.CommandListener):
+  def __init__(self):
+    self._commands = {}  # (connection, request ID) -> (collection, command)
+
+  def started(self, event):
+    collection = event.command.get(event.command_name)
+    if event.command_name == "getMore":
+      collection = event.command.get("collection")
+    if not isinstance(collection, str):
+      collection = ""  # Database commands
+    self._commands[(event.connection_id, event.request_id)] = (
+      collection,
+      event.command_name,
+    )
+
+  # Helper function to record a finished command, in the metrics of its request too
+  def _finish(self, event):
+    labels = self._commands.pop(
+      (event.connection_id, event.request_id), ("", event.command_name)
+    )
+    duration = event.duration_micros / 1e6
+    mongodb_command_duration.observe(duration, *labels)
+    if has_request_context() and "mongodb_commands" in g:
+      g.mongodb_commands += 1
+      g.mongodb_duration += duration
+    return labels
+
+  def succeeded(self, event):
+    self._finish(event)
+
+  def failed(self, event):
+    mongodb_command_failures.inc(*self._finish(event))
+
+
+command_timer = CommandTimer()
+
+
+# Helper function to get the labels of the current request
+def get_request_labels():
+  return request.blueprint or "", request.endpoint or ""
+
+
+def start_request():
+  g.request_start = time.perf_counter()
+  g.mongodb_commands = 0
+  g.mongodb_duration = 0
+
+
+def record_request(response):
+  if "request_start" not in g or request.endpoint == "metrics":
+    return response
+  blueprint, endpoint = get_request_labels()
+  request_duration.observe(
+    time.perf_counter() - g.request_start,
+    blueprint,
+    endpoint,
+    request.method,
+    response.status_code,
+  )
+  size = response.content_length
+  if size is None and not response.is_streamed:
+    size = response.calculate_content_length()
+  if size is not None:
+    response_size.observe(size, blueprint, endpoint)
+  request_mongodb_commands.observe(g.mongodb_commands, blueprint, endpoint)
+  request_mongodb_duration.observe(g.mongodb_duration, blueprint, endpoint)
+  return response
+
+
+# Helper function to render the stats of the caches as gauges
+def render_cache_stats():
+  # Imported here since extensions.py, which the caches depend on, imports this module
+  from imaginate_api.cache import cache
+  from imaginate_api.image.cache import image_cache
+
+  lines = []
+  for prefix, stats in [("cache", cache.stats()), ("image_cache", image_cache.stats())]:
+    for key, value in sorted(stats.items()):
+      if isinstance(value, (int, float)):
+        lines.append(f"# TYPE imaginate_{prefix}_{key} gauge")
+        lines.append(f"imaginate_{prefix}_{key} {value}")
+  return lines
+
+
+# GET /metrics: used by Prometheus to scrape the metrics of this process
+def get_metrics():
+  lines = []
+  for metric in METRICS:
+    lines += metric.render()
+  lines += render_cache_stats()
+  return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app):
+  if not app.config["METRICS_ENABLED"]:
+    return
+  app.before_request(start_request)
+  app.after_request(record_request)
+  app.add_url_rule("/metrics", "metrics", get_metrics)
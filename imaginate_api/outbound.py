@@ -0,0 +1,72 @@
+from flask import current_app
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import os
+import requests
+import threading
+
+# Statuses worth retrying, for idempotent methods only (i.e. never the OAuth token exchange)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+# Shared client for outbound HTTP calls (image downloads and OAuth providers)
+# - One session per process keeps connections alive in a pool per host
+# - Every call gets connect/read timeouts, idempotent calls are retried with backoff
+# - A semaphore caps how many upstream calls run at once, so a slow upstream cannot hold every server thread
+class OutboundClient:
+  def __init__(self):
+    self._session = None
+    self._semaphore = None
+    self._pid = None
+    self._lock = threading.Lock()
+
+  # Helper function to build the session on first use, and again in a forked process
+  def _get_session(self):
+    if self._session is not None and self._pid == os.getpid():
+      return self._session
+
+    with self._lock:
+      if self._session is None or self._pid != os.getpid():
+        config = current_app.config
+        retries = Retry(
+          total=config["OUTBOUND_RETRIES"],
+          backoff_factor=config["OUTBOUND_BACKOFF"],
+          status_forcelist=RETRY_STATUSES,
+          raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+          pool_connections=config["OUTBOUND_POOL_HOSTS"],
+          pool_maxsize=config["OUTBOUND_POOL_SIZE"],
+          max_retries=retries,
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        self._semaphore = threading.BoundedSemaphore(config["OUTBOUND_MAX_CONCURRENCY"])
+        self._session = session
+        self._pid = os.getpid()
+      return self._session
+
+  # Send a request, the whole body is read before the concurrency slot is released
+  # Raises a requests.RequestException on connection errors, timeouts or when no slot frees up in time
+  def request(self, method: str, url: str, **kwargs):
+    session = self._get_session()
+    config = current_app.config
+    kwargs.setdefault(
+      "timeout", (config["OUTBOUND_CONNECT_TIMEOUT"], config["OUTBOUND_READ_TIMEOUT"])
+    )
+    if not self._semaphore.acquire(timeout=config["OUTBOUND_READ_TIMEOUT"]):
+      raise requests.ConnectionError("Too many concurrent upstream requests")
+    try:
+      return session.request(method, url, **kwargs)
+    finally:
+      self._semaphore.release()
+
+  def get(self, url: str, **kwargs):
+    return self.request("GET", url, **kwargs)
+
+  def post(self, url: str, **kwargs):
+    return self.request("POST", url, **kwargs)
+
+
+http_client = OutboundClient()
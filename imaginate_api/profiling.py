@@ -0,0 +1,175 @@
+from flask import abort, current_app, jsonify, request, send_from_directory
+from http import HTTPStatus
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import random
+import re
+import secrets
+import threading
+import time
+import tracemalloc
+
+# Explanation of request profiling:
+# - With PROFILING_ENABLED, requests carrying the PROFILING_TOKEN in an X-Profile header are profiled, along with a
+#   PROFILING_SAMPLE_RATE fraction of all requests
+# - A profiled request runs under cProfile (CPU) and tracemalloc (allocations) around the whole WSGI app, so the
+#   streamed parts of responses are included (they are read before being sent)
+# - Profiles are saved to PROFILING_DIR, a .prof file for pstats/snakeviz and a .txt summary with the top functions
+#   and allocating lines, the newest PROFILING_MAX_FILES are kept
+# - GET /profiles lists the profiles and GET /profiles/<name> downloads one, both need the token
+# - Only one request is profiled at a time per process (both profilers are process wide), others run as usual
+
+PROFILE_HEADER = "X-Profile"
+
+# Rows of the summaries of profiles
+SUMMARY_ROWS = 30
+
+
+# Helper function to check the profiling token of a request, in constant time
+def has_token(token: str | None, header: str | None):
+  return bool(token and header and hmac.compare_digest(token, header))
+
+
+# WSGI middleware profiling requests, see init_app
+class ProfilerMiddleware:
+  def __init__(self, wsgi_app, config):
+    self.wsgi_app = wsgi_app
+    self.token = config["PROFILING_TOKEN"]
+    self.sample_rate = config["PROFILING_SAMPLE_RATE"]
+    self.directory = config["PROFILING_DIR"]
+    self.max_files = config["PROFILING_MAX_FILES"]
+    self._lock = threading.Lock()
+    os.makedirs(self.directory, exist_ok=True)
+
+  def __call__(self, environ, start_response):
+    requested = has_token(self.token, environ.get("HTTP_X_PROFILE"))
+    if not (requested or random.random() < self.sample_rate):
+      return self.wsgi_app(environ, start_response)
+    if not self._lock.acquire(blocking=False):
+      return self.wsgi_app(environ, start_response)  # Another request is being profiled
+    try:
+      return self.profile(environ, start_response)
+    finally:
+      self._lock.release()
+
+  # Run a request under the profilers and save its profile, returning the buffered response
+  def profile(self, environ, start_response):
+    name = get_profile_name(environ)
+
+    def start_profiled_response(status, headers, exc_info=None):
+      return start_response(status, [*headers, ("X-Profile-Id", name)], exc_info)
+
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+      iterable = self.wsgi_app(environ, start_profiled_response)
+      try:
+        body = list(iterable)
+      finally:
+        if hasattr(iterable, "close"):
+          iterable.close()
+    finally:
+      profiler.disable()
+      elapsed = time.perf_counter() - start
+      snapshot = tracemalloc.take_snapshot()
+      _, peak = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+      self.save(name, environ, profiler, snapshot, elapsed, peak)
+    return body
+
+  # Helper function to write the files of a profile, then remove the oldest profiles
+  def save(self, name, environ, profiler, snapshot, elapsed, peak):
+    profiler.dump_stats(os.path.join(self.directory, f"{name}.prof"))
+    summary = io.StringIO()
+    method, path = environ.get("REQUEST_METHOD"), environ.get("PATH_INFO")
+    summary.write(f"{method} {path}?{environ.get('QUERY_STRING', '')}\n")
+    summary.write(
+      f"Time: {elapsed * 1000:.2f} ms, peak traced memory: {peak / 1024:.1f} KiB\n\n"
+    )
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(
+      SUMMARY_ROWS
+    )
+    summary.write("Top allocating lines:\n")
+    for statistic in snapshot.statistics("lineno")[:SUMMARY_ROWS]:
+      summary.write(f"{statistic}\n")
+    with open(os.path.join(self.directory, f"{name}.txt"), "w") as file:
+      file.write(summary.getvalue())
+    print(f"Saved profile {name} ({elapsed * 1000:.2f} ms)")
+    self.prune()
+
+  # Helper function to keep the newest max_files profiles
+  def prune(self):
+    names = sorted(list_profiles(self.directory), reverse=True)
+    for name in names[self.max_files :]:
+      for extension in [".prof", ".txt"]:
+        try:
+          os.unlink(os.path.join(self.directory, name + extension))
+        except FileNotFoundError:
+          pass
+
+
+# Helper function to name the profile of a request, names sort by time
+def get_profile_name(environ):
+  now = time.time()
+  timestamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(now)) + f"{now % 1:.3f}"[1:]
+  method = environ.get("REQUEST_METHOD", "").lower()
+  path = re.sub(r"[^A-Za-z0-9]+", "-", environ.get("PATH_INFO", "")).strip("-")
+  return f"{timestamp}-{method}-{path[:60]}-{secrets.token_hex(3)}"
+
+
+# Helper function to list the names of the saved profiles
+def list_profiles(directory: str):
+  return [
+    entry.name.removesuffix(".prof")
+    for entry in os.scandir(directory)
+    if entry.name.endswith(".prof")
+  ]
+
+
+# Helper function to refuse requests without the profiling token
+def check_token():
+  if not has_token(
+    current_app.config["PROFILING_TOKEN"], request.headers.get(PROFILE_HEADER)
+  ):
+    abort(HTTPStatus.FORBIDDEN, description="Profiling token required")
+
+
+# GET /profiles: used for listing the saved profiles, newest first
+def get_profiles():
+  check_token()
+  names = sorted(list_profiles(current_app.config["PROFILING_DIR"]), reverse=True)
+  return jsonify(
+    [
+      {
+        "name": name,
+        "profile": f"profiles/{name}.prof",
+        "summary": f"profiles/{name}.txt",
+      }
+      for name in names
+    ]
+  )
+
+
+# GET /profiles/<filename>: used for downloading a profile (.prof) or its summary (.txt)
+def get_profile(filename):
+  check_token()
+  if not filename.endswith((".prof", ".txt")):
+    abort(HTTPStatus.NOT_FOUND, description="Profile not found")
+  return send_from_directory(current_app.config["PROFILING_DIR"], filename)
+
+
+def init_app(app):
+  if not app.config["PROFILING_ENABLED"]:
+    return
+  if not app.config["PROFILING_TOKEN"]:
+    print(
+      "Profiling is enabled without PROFILING_TOKEN, only sampled requests are profiled"
+    )
+  app.wsgi_app = ProfilerMiddleware(app.wsgi_app, app.config)
+  app.add_url_rule("/profiles", "profiles", get_profiles)
+  app.add_url_rule("/profiles/<filename>", "profile", get_profile)
@@ -1,78 +1,256 @@
+from bson import json_util
 from bson.objectid import ObjectId
-from flask_login import UserMixin
+from imaginate_api.cache import LRUCache, cache
+from imaginate_api.config import Config
 from imaginate_api.extensions import login_manager
 from imaginate_api.extensions import db
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from werkzeug.local import LocalProxy
+import click
+import time
 
 # Specification: https://flask-login.readthedocs.io/en/latest/#
 COLLECTION_NAME = "users"
-COLLECTION = db[COLLECTION_NAME]
+COLLECTION = LocalProxy(lambda: db[COLLECTION_NAME])
 
 
-class User(UserMixin):
-  def __init__(self, user_data=None):
-    self.user_data = user_data or {}
+# Fields of user documents that are loaded, which is all a User holds
+USER_PROJECTION = {"email": 1, "authenticated": 1, "active": 1}
+
+
+# Helper function to get the cache key of a user, users are cached since every logged in request loads one
+def get_cache_key(user_id):
+  return f"users:{user_id}"
+
+
+# Update of the user of a login: marks it as authenticated unless it was deactivated, a user it creates is active
+LOGIN_UPDATE = [
+  {"$set": {"active": {"$ifNull": ["$active", True]}}},
+  {
+    "$set": {
+      "authenticated": {"$or": [{"$ifNull": ["$authenticated", False]}, "$active"]}
+    }
+  },
+]
+
+
+# Helper function to apply the login update (and any fields) to the user matching a query, creating it with upsert
+# Returns the user document, or None when there is no such user
+def update_login(query: dict, fields: dict | None = None, upsert: bool = False):
+  return COLLECTION.find_one_and_update(
+    query,
+    [*LOGIN_UPDATE, {"$set": fields}] if fields else LOGIN_UPDATE,
+    projection=USER_PROJECTION,
+    upsert=upsert,
+    return_document=ReturnDocument.AFTER,
+  )
+
+
+# Cache of users, in front of the users collection
+# - Users are kept as User objects in a per-process LRU of USER_CACHE_MAX_ENTRIES for USER_CACHE_LOCAL_TTL seconds,
+#   so requests of a logged in player in quick succession do not even decode the user
+# - Behind it, users are kept in the cache backend (see cache.py) for USER_CACHE_TTL seconds, shared by the workers
+#   sharing the backend
+# - Updates through User invalidate both, other processes only drop their copy after USER_CACHE_LOCAL_TTL
+class UserCache:
+  def __init__(self, backend, max_entries: int, local_ttl: float, ttl: float):
+    self._backend = backend
+    # User ID -> (User, expiry), each entry counts as 1 towards max_entries
+    self._users = LRUCache(max_entries)
+    self.local_ttl = local_ttl
+    self.ttl = ttl
+
+  # Get a user by ID, loading its document with loader on a miss (None when the user does not exist)
+  def get(self, user_id: str, loader):
+    entry = self._users.get(user_id)
+    if entry is not None and time.time() < entry[1]:
+      return entry[0]
+
+    cached = self._backend.get(get_cache_key(user_id))
+    if cached is not None:
+      user = User.from_document(json_util.loads(cached))
+      self._users.set(user_id, (user, time.time() + self.local_ttl), 1)
+      return user
+    document = loader()
+    if document is None:
+      return None
+    return self.set(User.from_document(document))
+
+  # Cache a user that was just read from the users collection, in both levels
+  def set(self, user):
+    self._backend.set(
+      get_cache_key(user.id),
+      json_util.dumps(user.to_document()).encode("utf-8"),
+      self.ttl,
+    )
+    self._users.set(str(user.id), (user, time.time() + self.local_ttl), 1)
+    return user
+
+  def invalidate(self, user_id):
+    self._users.discard(str(user_id))
+    self._backend.delete(get_cache_key(user_id))
+
+  def clear(self):
+    self._users.clear()
+
+
+# Compact user, implementing what Flask-Login expects of a user class
+class User:
+  __slots__ = ("id", "email", "authenticated", "active")
+
+  def __init__(
+    self,
+    id: ObjectId,
+    email: str | None = None,
+    authenticated: bool = False,
+    active: bool = False,
+  ):
+    self.id = id
+    self.email = email
+    self.authenticated = authenticated
+    self.active = active
+
+  @classmethod
+  def from_document(cls, document: dict):
+    return cls(
+      document["_id"],
+      document.get("email"),
+      document.get("authenticated", False),
+      document.get("active", False),
+    )
+
+  def to_document(self):
+    return {
+      "_id": self.id,
+      "email": self.email,
+      "authenticated": self.authenticated,
+      "active": self.active,
+    }
 
   @property
   def is_authenticated(self):
-    return self.user_data.get("authenticated", False)
+    return self.authenticated
 
   @property
   def is_active(self):
-    return self.user_data.get("active", False)
+    return self.active
 
   @property
   def is_anonymous(self):
     return False  # Always return False based on specification
 
   def get_id(self):
-    return str(self.user_data["_id"])
+    return str(self.id)
 
   def get_clientside_data(self):
     return {
-      "email": self.user_data.get("email"),
+      "email": self.email,
     }
 
   def authenticate_user(self):
-    COLLECTION.update_one(
-      {"_id": self.user_data["_id"]}, {"$set": {"authenticated": True}}
-    )
-    self.user_data["authenticated"] = True
+    COLLECTION.update_one({"_id": self.id}, {"$set": {"authenticated": True}})
+    users.invalidate(self.id)
+    self.authenticated = True
 
   def deactivate_user(self):
-    COLLECTION.update_one({"_id": self.user_data["_id"]}, {"$set": {"active": False}})
-    self.user_data["active"] = False
+    COLLECTION.update_one({"_id": self.id}, {"$set": {"active": False}})
+    users.invalidate(self.id)
+    self.active = False
 
+  # Find the user of a login by its provider ID, else by its email, creating it on its first login
+  # A returning user takes a single update, a new one is created by an upsert and the unique indexes (see indexes.py)
+  # make concurrent first logins create one user: the upsert losing the race fails on a duplicate key and the login
+  # is resolved again
   @classmethod
   def find_or_create_user(cls, data, provider=None):
     # Primary identifier: Try to find the existing user by using the unique ID from the provider
     if provider:
-      existing_user = COLLECTION.find_one({f"{provider}_id": data["id"]})
-      if existing_user:
-        return User(user_data=existing_user)
-
-    # Secondary identifier: Try to find the existing user by using the email from the provider
-    existing_user = COLLECTION.find_one({"email": data["email"]})
-    if existing_user:
-      if provider:
-        COLLECTION.update_one(
-          {"_id": existing_user["_id"]}, {"$set": {f"{provider}_id": data["id"]}}
-        )
-      return User(user_data=existing_user)
-
-    # If no user is found, create a new one
-    data["authenticated"] = False
-    data["active"] = True
-    data[f"{provider}_id"] = data.pop("id")
-    new_user = COLLECTION.insert_one(data)
-    return User.get(new_user.inserted_id)
+      document = update_login({f"{provider}_id": data["id"]})
+      if document:
+        return users.set(User.from_document(document))
+
+    # Secondary identifier: Try to find the existing user by using the email from the provider, linking the provider
+    # ID, and create a new user if none is found
+    fields = {f"{provider}_id": data["id"]} if provider else None
+    try:
+      document = update_login({"email": data["email"]}, fields, upsert=True)
+    except DuplicateKeyError:
+      document = (provider and update_login({f"{provider}_id": data["id"]})) or (
+        update_login({"email": data["email"]})
+      )
+      if document is None:
+        raise
+    return users.set(User.from_document(document))
 
   # Get user by ID
   @classmethod
   def get(cls, user_id):
-    user = COLLECTION.find_one({"_id": ObjectId(user_id)})
-    if not user:
-      return None
-    return cls(user_data=user)
+    user_id = str(user_id)
+    return users.get(
+      user_id,
+      lambda: COLLECTION.find_one({"_id": ObjectId(user_id)}, USER_PROJECTION),
+    )
+
+
+users = UserCache(
+  cache,
+  Config.USER_CACHE_MAX_ENTRIES,
+  Config.USER_CACHE_LOCAL_TTL,
+  Config.USER_CACHE_TTL,
+)
+
+
+# Merge users sharing an email or a provider ID, which concurrent first logins created before the unique indexes
+# (see indexes.py), so that the indexes can be created
+# - The user kept is an active one, then an authenticated one, then the oldest, it takes the fields it lacks from the others
+# - A dry run only reports the users that would be merged
+# Returns the number of users merged (or to merge) away
+def merge_duplicate_users(collection=COLLECTION, dry_run: bool = False):
+  merged = 0
+  for field in ["email", *[f"{provider}_id" for provider in Config.AUTH_PROVIDERS]]:
+    pipeline = [
+      {"$match": {field: {"$type": "string"}}},
+      {"$group": {"_id": f"${field}", "ids": {"$push": "$_id"}}},
+      {"$match": {"ids.1": {"$exists": True}}},
+    ]
+    for group in list(collection.aggregate(pipeline, allowDiskUse=True)):
+      documents = sorted(
+        collection.find({"_id": {"$in": group["ids"]}}),
+        key=lambda document: (
+          not document.get("active"),
+          not document.get("authenticated"),
+          document["_id"],
+        ),
+      )
+      kept, others = documents[0], documents[1:]
+      other_ids = [document["_id"] for document in others]
+      print(
+        f'{field} "{group["_id"]}": keeping user {kept["_id"]}, merging {other_ids}'
+      )
+      merged += len(others)
+      if dry_run:
+        continue
+      update = {}
+      for document in others:
+        for key, value in document.items():
+          update.setdefault(key, value)
+      update = {key: value for key, value in update.items() if key not in kept}
+      collection.delete_many({"_id": {"$in": other_ids}})
+      if update:
+        collection.update_one({"_id": kept["_id"]}, {"$set": update})
+      for document in documents:
+        users.invalidate(document["_id"])
+  return merged
+
+
+# CLI: flask --app imaginate_api.app merge-duplicate-users [--dry-run]
+# Run once before creating the unique user indexes on a database that has duplicated users
+@click.command("merge-duplicate-users")
+@click.option("--dry-run", is_flag=True, help="Only report the users to merge.")
+def merge_duplicate_users_command(dry_run):
+  merged = merge_duplicate_users(dry_run=dry_run)
+  print(f"{'Would merge' if dry_run else 'Merged'} {merged} duplicate users")
 
 
 # Callback function for Flask login library to load user from session user_id
@@ -0,0 +1,156 @@
+from imaginate_api.cache import LocalCache, cache
+from imaginate_api.jobs import runner
+from waitress.server import create_server
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+# Explanation of the production server:
+# - Each worker process runs waitress with its own thread pool, so SERVER_WORKERS * SERVER_THREADS requests run at once
+# - Workers are forked from a master process and share its listening socket, the kernel spreads connections between them
+# - The master replaces workers that die, SIGHUP replaces every worker one by one (graceful restart) and SIGTERM/SIGINT stops them
+# - A worker asked to stop no longer accepts connections and exits once its in-flight requests and background jobs are
+#   done (or after SERVER_GRACEFUL_TIMEOUT)
+
+
+# Helper function to get the waitress adjustments from the config
+def get_server_options(config):
+  return {
+    "threads": config["SERVER_THREADS"],
+    "connection_limit": config["SERVER_CONNECTION_LIMIT"],
+    "backlog": config["SERVER_BACKLOG"],
+    "channel_timeout": config["SERVER_CHANNEL_TIMEOUT"],
+  }
+
+
+# Helper function to stop accepting connections and exit once in-flight requests and running jobs are done
+# Jobs still running at the deadline are handed back (see jobs.py)
+def drain(server, timeout: float):
+  server.accepting = False
+  deadline = time.time() + timeout
+  while time.time() < deadline and any(
+    channel.requests for channel in list(server.active_channels.values())
+  ):
+    time.sleep(0.1)
+  runner.stop(max(0, deadline - time.time()))
+  os._exit(0)
+
+
+# Serve the app in the current process, listening on sock or on the configured host and port
+def serve_worker(app, sock=None):
+  options = get_server_options(app.config)
+  if sock is None:
+    options.update(host=app.config["SERVER_HOST"], port=app.config["SERVER_PORT"])
+  else:
+    options["sockets"] = [sock]
+  server = create_server(app, **options)
+
+  def handle_stop(signum, frame):
+    threading.Thread(
+      target=drain, args=(server, app.config["SERVER_GRACEFUL_TIMEOUT"]), daemon=True
+    ).start()
+
+  signal.signal(signal.SIGTERM, handle_stop)
+  signal.signal(signal.SIGINT, handle_stop)
+  print(f"Worker {os.getpid()} serving with {options['threads']} threads")
+  server.run()
+
+
+class Master:
+  def __init__(self, app):
+    self.app = app
+    self.workers = {}  # PID -> worker number
+    self.stopping = False
+    self.restarting = False
+    self.sock = socket.create_server(
+      (app.config["SERVER_HOST"], app.config["SERVER_PORT"]),
+      backlog=app.config["SERVER_BACKLOG"],
+    )
+
+  def spawn(self, number: int):
+    pid = os.fork()
+    if pid == 0:
+      signal.signal(signal.SIGHUP, signal.SIG_IGN)  # Only the master restarts
+      try:
+        serve_worker(self.app, self.sock)
+      finally:
+        os._exit(0)
+    self.workers[pid] = number
+
+  # Wait for a worker to exit, returning its (PID, number) or None if none exited in time
+  def reap(self, timeout: float = 1):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+      try:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+      except ChildProcessError:
+        return None
+      if pid:
+        number = self.workers.pop(pid, None)
+        if status and not self.stopping:
+          print(f"Worker {pid} exited with status {status}", file=sys.stderr)
+        return pid, number
+      time.sleep(0.1)
+    return None
+
+  # Replace workers one at a time, so the others keep serving while each one drains
+  def restart(self):
+    self.restarting = True
+    for pid, number in list(self.workers.items()):
+      self.spawn(number)
+      os.kill(pid, signal.SIGTERM)
+      while pid in self.workers and not self.stopping:
+        reaped = self.reap()
+        if reaped and reaped[0] != pid:
+          self.spawn(reaped[1])  # Another worker died meanwhile
+    self.restarting = False
+
+  def stop(self):
+    self.stopping = True
+    for pid in list(self.workers):
+      os.kill(pid, signal.SIGTERM)
+    deadline = time.time() + self.app.config["SERVER_GRACEFUL_TIMEOUT"] + 5
+    while self.workers and time.time() < deadline:
+      self.reap()
+    for pid in list(self.workers):
+      os.kill(pid, signal.SIGKILL)
+
+  def run(self):
+    def handle_hup(signum, frame):
+      self.restarting = True
+
+    def handle_stop(signum, frame):
+      self.stopping = True
+
+    signal.signal(signal.SIGHUP, handle_hup)
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+
+    for number in range(self.app.config["SERVER_WORKERS"]):
+      self.spawn(number)
+    host, port = self.sock.getsockname()[:2]
+    print(f"Master {os.getpid()} serving on {host}:{port}")
+
+    while not self.stopping:
+      if self.restarting:
+        self.restart()
+        continue
+      reaped = self.reap()
+      if reaped and not self.stopping:
+        self.spawn(reaped[1])  # Replace the worker that died
+    self.stop()
+
+
+# Run the production server, forking workers when more than one is configured (and the platform supports it)
+def run(app):
+  if app.config["SERVER_WORKERS"] > 1 and hasattr(os, "fork"):
+    if isinstance(cache, LocalCache):
+      raise RuntimeError(
+        "CACHE_BACKEND=local is not shared by server workers, use disk or redis"
+      )
+    Master(app).run()
+  else:
+    serve_worker(app)
@@ -1,5 +1,6 @@
 from flask import Blueprint, abort, request, redirect, url_for, session, current_app
 from flask_login import current_user, login_user
+from imaginate_api.outbound import http_client
 from imaginate_api.schemas.user_info import User
 from http import HTTPStatus
 from urllib.parse import urlencode
@@ -61,17 +62,20 @@ def user_callback(provider):
     abort(HTTPStatus.BAD_REQUEST, description="Authorization error")
 
   # Get an access token from the authorization code
-  response = requests.post(
-    provider_data["token_url"],
-    data={
-      "client_id": provider_data["client_id"],
-      "client_secret": provider_data["client_secret"],
-      "code": request.args["code"],
-      "grant_type": "authorization_code",
-      "redirect_uri": url_for("user.user_callback", provider=provider, _external=True),
-    },
-    headers={"Accept": "application/json"},
-  )
+  try:
+    response = http_client.post(
+      provider_data["token_url"],
+      data={
+        "client_id": provider_data["client_id"],
+        "client_secret": provider_data["client_secret"],
+        "code": request.args["code"],
+        "grant_type": "authorization_code",
+        "redirect_uri": url_for("user.user_callback", provider=provider, _external=True),
+      },
+      headers={"Accept": "application/json"},
+    )
+  except requests.RequestException:
+    abort(HTTPStatus.BAD_GATEWAY, description="Authorization error")
   if not response.ok:
     abort(response.status_code, description="Authorization error")
   response_data = response.json()
@@ -80,10 +84,13 @@ def user_callback(provider):
     abort(HTTPStatus.UNAUTHORIZED, description="Authorization error")
 
   # Get the requested data
-  response = requests.get(
-    provider_data["user_info"]["url"],
-    headers={"Authorization": f"Bearer {token}", "Accept": "application/json"},
-  )
+  try:
+    response = http_client.get(
+      provider_data["user_info"]["url"],
+      headers={"Authorization": f"Bearer {token}", "Accept": "application/json"},
+    )
+  except requests.RequestException:
+    abort(HTTPStatus.BAD_GATEWAY, description="Authorization error")
   if not response.ok:
     abort(response.status_code, description="Authorization error")
 
@@ -92,7 +99,6 @@ def user_callback(provider):
   user = User.find_or_create_user(user_data, provider)
   success = login_user(user)
   if success:
-    user.authenticate_user()
     return redirect(f'{current_app.config["BASE_URL"]}/?{urlencode(user.get_clientside_data())}')
 
   return redirect(current_app.config["BASE_URL"])
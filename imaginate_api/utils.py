@@ -1,14 +1,29 @@
-from flask import abort, current_app
+from flask import abort, current_app, request, stream_with_context
 from bson.errors import InvalidId
 from bson.objectid import ObjectId
 from http import HTTPStatus
 from imaginate_api.extensions import fs
+from imaginate_api.outbound import http_client
 import requests
-from werkzeug.datastructures import FileStorage
+from werkzeug.datastructures import ContentRange, FileStorage
 from io import BytesIO
-from urllib.parse import urlparse
+from urllib.parse import parse_qsl, urlencode, urlparse, urlsplit, urlunsplit
+from imaginate_api.date.schedule import schedule
 from imaginate_api.schemas.date_info import DateInfo
 
+# Stored files never change for a given ID, so clients may cache them for a year
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Ports left out of normalized URLs
+DEFAULT_PORTS = {"http": ":80", "https": ":443"}
+
+# Metadata fields of an image, used to project queries on fs.files
+IMAGE_PROJECTION = {"filename": 1, "date": 1, "theme": 1, "real": 1, "status": 1}
+
+# Page sizes of listing endpoints
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+
 
 # Helper function to get boolean
 def str_to_bool(string: str):
@@ -26,14 +41,73 @@ def validate_id(image_id: str | ObjectId | bytes):
   return _id
 
 
-# Helper function to search MongoDB ID
+# Helper function to search MongoDB ID, renditions and hidden blobs are not images so they are never found
 def search_id(_id: ObjectId):
-  res = next(fs.find({"_id": _id}), None)
+  res = next(fs.find({"_id": _id, "kind": {"$exists": False}}), None)
   if not res:
     abort(HTTPStatus.NOT_FOUND, "Collection not found")
   return res
 
 
+# Helper function to get the GridFS file holding the content of an image
+# Deduplicated images point at the file that owns their content through "blob_id", see image/storage.py
+def resolve_blob(grid_out):
+  blob_id = getattr(grid_out, "blob_id", None)
+  return grid_out if blob_id is None else fs.get(blob_id)
+
+
+# Helper function to yield a GridFS file chunk by chunk rather than reading it whole
+def iter_grid_out(grid_out, start: int = 0, end: int | None = None):
+  grid_out.seek(start)
+  remaining = (grid_out.length if end is None else end) - start
+  while remaining > 0:
+    chunk = grid_out.readchunk()
+    if not chunk:
+      break
+    chunk = chunk[:remaining]
+    remaining -= len(chunk)
+    yield chunk
+
+
+# Helper function to build a streamed response of a GridFS file, supporting conditional and range requests
+def build_file_response(grid_out):
+  content = resolve_blob(grid_out)
+  etag = str(grid_out._id)
+  response = current_app.response_class(mimetype=grid_out.type)
+  response.set_etag(etag)
+  response.accept_ranges = "bytes"
+  response.cache_control.public = True
+  response.cache_control.max_age = IMMUTABLE_MAX_AGE
+  response.cache_control.immutable = True
+
+  if request.if_none_match.contains_weak(etag):
+    response.status_code = HTTPStatus.NOT_MODIFIED
+    return response
+
+  # Only a single byte range is supported, others are answered with the full file
+  start, end = 0, content.length
+  byte_range = request.range
+  if_range = request.if_range
+  if (
+    byte_range
+    and byte_range.units == "bytes"
+    and len(byte_range.ranges) == 1
+    and (not (if_range.etag or if_range.date) or if_range.etag == etag)
+  ):
+    bounds = byte_range.range_for_length(content.length)
+    if bounds is None:
+      response.status_code = HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+      response.content_range = ContentRange("bytes", None, None, content.length)
+      return response
+    start, end = bounds
+    response.status_code = HTTPStatus.PARTIAL_CONTENT
+    response.content_range = ContentRange("bytes", start, end, content.length)
+
+  response.response = stream_with_context(iter_grid_out(content, start, end))
+  response.content_length = end - start
+  return response
+
+
 # Helper function to build schema-matching JSON response
 def build_result(
   _id: ObjectId, real: bool, date: int, theme: str, status: str, filename: str
@@ -48,6 +122,51 @@ def build_result(
   }
 
 
+# Helper function to build schema-matching JSON response from a raw fs.files document
+def build_document_result(document: dict):
+  return build_result(
+    document["_id"],
+    document.get("real"),
+    document.get("date"),
+    document.get("theme"),
+    document.get("status"),
+    document.get("filename"),
+  )
+
+
+# Helper function to build an fs.files query from the filters of a listing request
+def build_image_query(args):
+  query = {"kind": {"$exists": False}}  # Skip renditions and blobs
+  try:
+    date_from = calculate_date(args.get("date_from"))
+    date_to = calculate_date(args.get("date_to"))
+  except ValueError:
+    abort(HTTPStatus.BAD_REQUEST, description="Invalid date")
+  if date_from is not None:
+    query.setdefault("date", {})["$gte"] = date_from
+  if date_to is not None:
+    query.setdefault("date", {})["$lte"] = date_to
+  for field in ["theme", "status"]:
+    if args.get(field):
+      query[field] = args[field]
+  if args.get("real"):
+    query["real"] = str_to_bool(args["real"])
+  return query
+
+
+# Helper function to get the page size of a listing request
+def get_page_limit(args):
+  try:
+    limit = int(args.get("limit", DEFAULT_PAGE_LIMIT))
+  except ValueError:
+    abort(HTTPStatus.BAD_REQUEST, description="Invalid limit")
+  if not 0 < limit <= MAX_PAGE_LIMIT:
+    abort(
+      HTTPStatus.BAD_REQUEST, description=f"Limit should be in [1, {MAX_PAGE_LIMIT}]"
+    )
+  return limit
+
+
 # Helper function to validate POST image/create endpoint
 def validate_post_image_create_request(file, date, theme, real):
   if any(x is None for x in [file, date, theme, real]):
@@ -73,14 +192,32 @@ def validate_url(url):
     return False
 
 
+# Helper function to normalize a URL, so that different spellings of the same source compare equal
+def normalize_url(url):
+  if not validate_url(url):
+    abort(HTTPStatus.BAD_REQUEST, description=f"Malformed URL: {url}")
+  parts = urlsplit(url.strip())
+  scheme, netloc = parts.scheme.lower(), parts.netloc.lower()
+  port = DEFAULT_PORTS.get(scheme)
+  if port and netloc.endswith(port):
+    netloc = netloc[: -len(port)]
+  query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+  return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
 def build_image_from_url(url):
   if not validate_url(url):
     abort(HTTPStatus.BAD_REQUEST, description=f"Malformed URL: {url}")
 
   # Get raw content of the source image
-  photo_response = requests.get(
-    url, headers={"Authorization": current_app.config["PEXELS_TOKEN"]}, stream=True
-  )
+  try:
+    photo_response = http_client.get(
+      url, headers={"Authorization": current_app.config["PEXELS_TOKEN"]}
+    )
+  except requests.Timeout:
+    abort(HTTPStatus.GATEWAY_TIMEOUT, description=f"Request to URL timed out: {url}")
+  except requests.RequestException as exc:
+    abort(HTTPStatus.BAD_GATEWAY, description=f"Request to URL failed with: {exc}")
   if not photo_response.ok:
     abort(
       photo_response.status_code,
@@ -119,33 +256,11 @@ def calculate_date(day: str | int | None, db=None, latest_day=None):
     if latest_day is None:
       return timestamp_day
 
+    # Resolve through the day schedule, which only queries the database when the day rolls over
     if db is not None:
-
-      # Check if the date requested exists regardless of cycle
-      document = db['days'].find_one({"day": day})
-      if document:
-        print("Day for date exists, Circular date ignored")
-        return timestamp_day
-
-      # Check for days that have not been shown yet
-      new_day = db['days'].find_one_and_update({
-        # Find days that have not appeared yet, or appeared today
-          "$or": [
-          {"appearances": {"$size": 0}},
-          {"appearances": {"$elemMatch": {"$eq": timestamp_day}}},
-          {"appearances": {"$exists": False}}
-          ]
-        },
-        # Add the current date to the appearances array
-        {
-          "$addToSet": {"appearances": timestamp_day},
-        },
-        return_document=True,
-      )
-
-      if(new_day):
-        print("New content found, returning date")
-        return new_day['_id']
+      date = schedule.resolve(db, day, timestamp_day)
+      if date is not None:
+        return date
 
     MIN = DateInfo.START_DATE.value
     MAX = latest_day + DateInfo.SECONDS_PER_DAY.value
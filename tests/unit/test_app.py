@@ -1,6 +1,14 @@
+import base64
+import gzip
+import hashlib
+import json
+import subprocess
+import sys
 import gridfs.grid_file
 import mongomock.gridfs
 import pytest
+import threading
+import time
 
 # Core libraries
 import gridfs
@@ -14,13 +22,41 @@ from imaginate_api.utils import (
   calculate_date,
 )
 from imaginate_api.app import create_app
+from imaginate_api.config import Config
+from imaginate_api.cache import DiskCache, LocalCache, cache, create_cache
+from imaginate_api.date.bundle import Bundle, BundleCache, bundles
+from imaginate_api.date.latest import latest
+from imaginate_api.date.schedule import schedule
+from imaginate_api.extensions import MongoConnection
+from imaginate_api.image.cache import image_cache
+from imaginate_api.image.storage import store_image
+from imaginate_api.jobs import JOB_TYPES, runner
+from imaginate_api import metrics
+from imaginate_api.metrics import command_timer
+from imaginate_api.indexes import (
+  INDEXES,
+  ensure_indexes,
+  get_plan_stages,
+)
 from imaginate_api.schemas.date_info import DateInfo
+from imaginate_api.schemas.user_info import (
+  User,
+  load_user,
+  merge_duplicate_users,
+  users,
+)
 
 # Other
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.exceptions import BadRequest, NotFound, HTTPException
 from werkzeug.datastructures import FileStorage
+from gridfs.errors import FileExists
+from pymongo.errors import DuplicateKeyError
 from bson.objectid import ObjectId
+from flask import g
+from datetime import datetime, timedelta, timezone
 from io import BytesIO
+from PIL import Image
 from http import HTTPStatus
 from image_handler_client.schemas.image_info import ImageStatus
 
@@ -79,14 +115,32 @@ def mock_data():
   return mock_data
 
 
+# Helper function to poll a job until it is finished
+def wait_for_job(client, status_url: str):
+  for _ in range(200):
+    job = client.get(status_url).json
+    if job["state"] in ["done", "failed"]:
+      return job
+    time.sleep(0.01)
+  return job
+
+
 # Set up database before running tests
 @pytest.fixture(autouse=True)
-def setup(mock_fs):
+def setup(mock_fs, mock_db):
   with (
     patch("imaginate_api.date.routes.fs", mock_fs),
-    patch("imaginate_api.image.routes.fs", mock_fs),
+    patch("imaginate_api.image.purge.db", mock_db),
+    patch("imaginate_api.jobs.db", mock_db),
+    patch("imaginate_api.job.routes.db", mock_db),
     patch("imaginate_api.utils.fs", mock_fs),
+    patch("imaginate_api.date.latest.fs", mock_fs),
+    patch("imaginate_api.image.storage.fs", mock_fs),
+    patch("imaginate_api.image.storage.db", mock_db),
+    patch("imaginate_api.image.renditions.fs", mock_fs),
   ):
+    cache.clear()
+    schedule.clear()
     yield
 
 
@@ -167,14 +221,60 @@ def test_calculate_date(data, expected):
   assert calculate_date(*data) == expected
 
 
+def test_calculate_date_schedule(mock_db):
+  days = [calculate_date(i) for i in range(3)]
+  mock_db["days"].insert_many(
+    [{"_id": days[0], "day": 0, "appearances": []}, {"_id": days[1], "day": 1}]
+  )
+
+  # Existing days resolve to themselves, new days are assigned unshown content once
+  assert calculate_date(0, mock_db, days[1]) == days[0]
+  assert calculate_date(2, mock_db, days[1]) == days[0]
+  assert mock_db["days"].find_one({"_id": days[0]})["appearances"] == [days[2]]
+  with patch.object(mock_db["days"], "find_one_and_update") as mock_update:
+    assert calculate_date(2, mock_db, days[1]) == days[0]
+    mock_update.assert_not_called()
+
+  # Assignments are persisted and picked up when the schedule is reloaded
+  schedule.clear()
+  with patch.object(mock_db["days"], "find_one_and_update") as mock_update:
+    assert calculate_date(2, mock_db, days[1]) == days[0]
+    mock_update.assert_not_called()
+
+
+def test_day_schedule_concurrent_load(mock_db):
+  mock_db["days"].insert_one({"_id": 0, "day": 0, "appearances": []})
+  load = schedule.load
+
+  def slow_load(db):
+    time.sleep(0.05)
+    load(db)
+
+  with (
+    patch.object(schedule, "load", side_effect=slow_load) as mock_load,
+    ThreadPoolExecutor(8) as executor,
+  ):
+    results = list(executor.map(lambda _: schedule.resolve(mock_db, 0, 0), range(8)))
+  assert results == [0] * 8
+  mock_load.assert_called_once()
+
+
 # Not testing as this endpoint will likely be removed in future
 def test_get_root_endpoint():
   pass
 
 
-# Not testing as this endpoint will likely be removed in future
-def test_get_image_read_all_endpoint():
-  pass
+def test_get_image_read_all_endpoint(mock_fs, mock_db, mock_data, client):
+  ids = [mock_fs.put(**entry) for entry in mock_data]
+  with patch("imaginate_api.image.routes.db", mock_db):
+    res = client.get("/image/read?limit=3")
+    assert res.status_code == HTTPStatus.OK
+    assert all(f"read/{_id}" in res.text for _id in ids[:3])
+    assert f"after={ids[2]}" in res.text
+
+    res = client.get(f"/image/read?limit=3&after={ids[2]}")
+    assert all(f"read/{_id}" in res.text for _id in ids[3:])
+    assert "Next" not in res.text
 
 
 def test_post_image_create_endpoint_success(client, mock_data):
@@ -230,7 +330,7 @@ def test_post_image_create_endpoint_success(client, mock_data):
   ],
 )
 def test_post_image_create_endpoint_status_code(data, expected, client):
-  with patch("requests.get") as mock_get:
+  with patch("imaginate_api.utils.http_client.get") as mock_get:
     mock_response = MagicMock()
     mock_response.content = data["file"].stream.read()
     mock_response.headers.get = MagicMock(return_value=data["file"].content_type)
@@ -239,6 +339,123 @@ def test_post_image_create_endpoint_status_code(data, expected, client):
     assert res.status_code == expected
 
 
+def test_post_image_create_bulk_endpoint(mock_fs, client):
+  entries = [
+    {"url": f"https://example.com/{i}.png", "date": i, "theme": "sample", "real": True}
+    for i in range(3)
+  ]
+  entries.append({"url": "not-a-url", "date": 0, "theme": "sample", "real": True})
+  entries.append({"file": "upload", "date": 0, "theme": "sample", "real": "false"})
+  with patch("imaginate_api.utils.http_client.get") as mock_get:
+    mock_get.return_value.content = b"data"
+    mock_get.return_value.headers.get = MagicMock(return_value="image/png")
+    res = client.post(
+      "/image/create-bulk",
+      data={
+        "images": json.dumps(entries),
+        "upload": FileStorage(
+          stream=BytesIO(b"data"), filename="upload.png", content_type="image/png"
+        ),
+      },
+      content_type="multipart/form-data",
+    )
+  assert res.status_code == HTTPStatus.MULTI_STATUS
+  assert [result["code"] for result in res.json] == [200, 200, 200, 400, 200]
+  assert res.json[4]["result"]["filename"] == "upload.png"
+  assert len(list(mock_fs.find({"theme": "sample"}))) == 4
+
+
+def test_post_image_create_bulk_endpoint_background(mock_fs, client):
+  entries = [
+    {"url": f"https://example.com/{i}.png", "date": i, "theme": "sample", "real": True}
+    for i in range(3)
+  ]
+  with patch("imaginate_api.utils.http_client.get") as mock_get:
+    mock_get.return_value.content = b"data"
+    mock_get.return_value.headers.get = MagicMock(return_value="image/png")
+    res = client.post("/image/create-bulk?background=true", json={"images": entries})
+    assert res.status_code == HTTPStatus.ACCEPTED
+    job = wait_for_job(client, res.json["status_url"])
+  assert job["type"] == "ingest" and job["state"] == "done"
+  assert job["progress"] == {"done": 3, "total": 3}
+  assert [result["code"] for result in job["result"]] == [200, 200, 200]
+  assert len(list(mock_fs.find({"theme": "sample"}))) == 3
+  assert client.get("/jobs/?type=ingest").json[0]["id"] == res.json["id"]
+
+  entries = [{"file": "upload", "date": 0, "theme": "sample", "real": True}]
+  res = client.post("/image/create-bulk?background=true", json={"images": entries})
+  assert res.status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_job_runner_retry(client):
+  calls = []
+
+  def flaky(params, progress):
+    calls.append(params)
+    if len(calls) < 2:
+      raise RuntimeError("Temporary failure")
+    return {"calls": len(calls)}
+
+  def invalid(params, progress):
+    raise BadRequest(description="Invalid parameters")
+
+  client.application.config["JOB_RETRY_BACKOFF"] = 0
+  jobs = {"flaky": (flaky, 1, None), "invalid": (invalid, None, None)}
+  with patch.dict(JOB_TYPES, jobs), client.application.test_request_context():
+    flaky_id = runner.submit("flaky", {"n": 1})
+    invalid_id = runner.submit("invalid")
+    job = wait_for_job(client, f"/jobs/{flaky_id}")
+    assert job["state"] == "done" and job["attempts"] == 2
+    assert job["result"] == {"calls": 2}
+    # Client errors are not retried
+    job = wait_for_job(client, f"/jobs/{invalid_id}")
+    assert job["state"] == "failed" and job["attempts"] == 1
+    assert job["error"] == "Invalid parameters"
+  assert client.get(f"/jobs/{ObjectId()}").status_code == HTTPStatus.NOT_FOUND
+
+
+def test_job_runner_recover(client, mock_db):
+  calls = []
+  started, release = threading.Event(), threading.Event()
+
+  def once(params, progress):
+    calls.append(params)
+    return {}
+
+  def blocking(params, progress):
+    started.set()
+    release.wait(5)
+    return {}
+
+  jobs = {"once": (once, None, 1), "blocking": (blocking, None, 2)}
+  stale = datetime(2020, 1, 1, tzinfo=timezone.utc)
+  with patch.dict(JOB_TYPES, jobs), client.application.test_request_context():
+    runner.start(client.application)
+    job = {"params": {}, "attempts": 0, "created": stale, "updated": stale}
+    # Interrupted on its last attempt, it must not run again
+    interrupted = {**job, "type": "once", "state": "running", "attempts": 1}
+    interrupted_id = mock_db["jobs"].insert_one(interrupted).inserted_id
+    # Waiting for its retry
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=0.5)
+    delayed = {**job, "type": "once", "state": "queued", "retry_at": retry_at}
+    delayed_id = mock_db["jobs"].insert_one({**delayed, "params": {"n": 1}}).inserted_id
+    runner.recover(client.application)
+    job = wait_for_job(client, f"/jobs/{interrupted_id}")
+    assert job["state"] == "failed"
+    assert job["error"] == "Interrupted on its last attempt"
+    assert client.get(f"/jobs/{delayed_id}").json["state"] == "queued"
+    assert wait_for_job(client, f"/jobs/{delayed_id}")["state"] == "done"
+    assert calls == [{"n": 1}]
+
+    # Jobs still running when the runner stops are handed back
+    blocking_id = runner.submit("blocking")
+    assert started.wait(5)
+    runner.stop(0.1)
+    assert mock_db["jobs"].find_one({"_id": blocking_id})["state"] == "queued"
+    release.set()
+    assert wait_for_job(client, f"/jobs/{blocking_id}")["state"] == "done"
+
+
 # Not testing scenarios with exceptions as they have been tested by helper functions:
 # validate_id, search_id
 def test_get_image_read_endpoint(mock_fs, mock_data, client):
@@ -249,6 +466,170 @@ def test_get_image_read_endpoint(mock_fs, mock_data, client):
     assert res.data == entry["data"]
 
 
+def test_get_image_read_endpoint_conditional(mock_fs, mock_data, client):
+  entry = mock_data[0]
+  _id = mock_fs.put(**entry)
+  res = client.get(f"/image/read/{_id}", headers={"Range": "bytes=1-2"})
+  assert res.status_code == HTTPStatus.PARTIAL_CONTENT
+  assert res.data == entry["data"][1:3]
+  assert res.headers["Content-Range"] == f"bytes 1-2/{len(entry['data'])}"
+
+  res = client.get(f"/image/read/{_id}", headers={"Range": "bytes=100-"})
+  assert res.status_code == HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+
+  res = client.get(f"/image/read/{_id}", headers={"If-None-Match": f'"{_id}"'})
+  assert res.status_code == HTTPStatus.NOT_MODIFIED
+  assert res.data == b""
+
+
+def test_get_image_read_endpoint_rendition(mock_fs, client):
+  data = BytesIO()
+  Image.new("RGB", (1000, 500), "red").save(data, "PNG")
+  _id = mock_fs.put(data.getvalue(), filename="red.png", type="image/png")
+
+  res = client.get(f"/image/read/{_id}?size=300", headers={"Accept": "image/webp"})
+  assert res.status_code == HTTPStatus.OK
+  assert res.headers["Content-Type"] == "image/webp"
+  assert "Accept" in res.headers["Vary"]
+  assert Image.open(BytesIO(res.data)).size == (320, 160)
+
+  # Clients accepting anything may not decode WebP
+  for accept in ["*/*", "image/*"]:
+    res = client.get(f"/image/read/{_id}?size=300", headers={"Accept": accept})
+    assert Image.open(BytesIO(res.data)).format == "JPEG"
+
+  res = client.get(f"/image/read/{_id}?size=300&format=jpeg")
+  assert res.headers["Content-Type"] == "image/jpeg"
+  assert len(list(mock_fs.find({"rendition_of": _id}))) == 2
+
+  res = client.get(f"/image/read/{_id}?format=gif")
+  assert res.status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_post_image_create_endpoint_deduplication(mock_fs, mock_db, client):
+  ids = []
+  urls = ["https://Example.com:443/a.png?w=1&h=2", "https://example.com/a.png?h=2&w=1"]
+  for url in urls:
+    with patch("imaginate_api.utils.http_client.get") as mock_get:
+      mock_get.return_value.content = b"data"
+      mock_get.return_value.headers.get = MagicMock(return_value="image/png")
+      data = {"url": url, "date": 0, "theme": "sample", "real": True}
+      res = client.post("/image/create", data=data, content_type="multipart/form-data")
+    assert res.status_code == HTTPStatus.OK
+    ids.append(res.json["url"].split("/")[-1])
+  assert mock_get.call_count == 0  # The second URL is the same source as the first
+  owner = mock_db["fs.files"].find_one({"_id": ObjectId(ids[0])})
+  assert owner["refs"] == 2
+  assert mock_db["fs.chunks"].count_documents({}) == 1
+
+  # The owner is kept for the image still using its content
+  assert client.delete(f"/image/{ids[0]}").status_code == HTTPStatus.OK
+  assert mock_db["fs.files"].find_one({"_id": owner["_id"]})["kind"] == "blob"
+  assert client.get(f"/image/read/{ids[0]}").status_code == HTTPStatus.NOT_FOUND
+  res = client.get(f"/image/read/{ids[0]}/properties")
+  assert res.status_code == HTTPStatus.NOT_FOUND
+  assert client.delete(f"/image/{ids[0]}").status_code == HTTPStatus.NOT_FOUND
+  assert mock_db["fs.files"].find_one({"_id": owner["_id"]})["refs"] == 1
+  assert client.get(f"/image/read/{ids[1]}").data == b"data"
+  with patch("imaginate_api.image.routes.db", mock_db):
+    assert client.get("/image/all-images").json[0]["url"].endswith(ids[1])
+
+  assert client.delete(f"/image/{ids[1]}").status_code == HTTPStatus.OK
+  assert mock_db["fs.files"].count_documents({}) == 0
+  assert mock_db["fs.chunks"].count_documents({}) == 0
+
+
+def test_store_image_unreferenced_content(mock_fs, mock_db, client):
+  sha256 = hashlib.sha256(b"data").hexdigest()
+  left_id = mock_fs.put(b"data", sha256=sha256, refs=0)  # An interrupted deletion
+  with client.application.app_context():
+    _id = store_image(FileStorage(BytesIO(b"data"), "a.png"), 0, "a", True, "verified")
+    assert mock_db["fs.files"].find_one({"_id": _id})["refs"] == 1
+    assert mock_db["fs.files"].find_one({"_id": left_id}) is None
+
+    # Stores keep losing to concurrent ones
+    with patch("imaginate_api.image.storage.fs.put", side_effect=FileExists):
+      with pytest.raises(HTTPException) as exc:
+        store_image(FileStorage(BytesIO(b"new"), "a.png"), 0, "a", True, "verified")
+    assert exc.value.code == HTTPStatus.SERVICE_UNAVAILABLE
+
+
+def test_delete_rejected_endpoint_purge(mock_db, client):
+  with client.application.app_context():
+    images = [
+      (b"shared", "rejected"),
+      (b"shared", "verified"),
+      (b"own", "rejected"),
+      (b"gone", "rejected"),
+    ]
+    ids = [
+      store_image(FileStorage(BytesIO(data), "a.png"), 0, "a", True, status)
+      for data, status in images
+    ]
+  files, chunks = mock_db["fs.files"], mock_db["fs.chunks"]
+
+  res = client.delete("/image/delete-rejected?dry_run=true")
+  assert res.json == {"images": 3, "bytes": 13, "dry_run": True, "deleted": 3}
+  assert files.count_documents({}) == 4
+
+  client.application.config["PURGE_BATCH_SIZE"] = 2
+  res = client.delete("/image/delete-rejected")
+  assert res.json == {"deleted": 3, "images": 3, "files": 2, "chunks": 2}
+  # The shared content is still used by the verified image
+  assert files.find_one({"_id": ids[0]})["kind"] == "blob"
+  assert client.get(f"/image/read/{ids[1]}").data == b"shared"
+  assert chunks.count_documents({}) == 1
+
+  # Purges above the threshold run in the background
+  files.update_one({"_id": ids[1]}, {"$set": {"status": "rejected"}})
+  client.application.config["PURGE_BACKGROUND_THRESHOLD"] = 0
+  res = client.delete("/image/delete-rejected")
+  assert res.status_code == HTTPStatus.ACCEPTED
+  job = wait_for_job(client, res.json["status_url"])
+  assert job["state"] == "done" and job["result"]["images"] == 1
+  assert files.count_documents({}) == chunks.count_documents({}) == 0
+
+
+def test_sweep_orphaned_chunks_endpoint(mock_fs, mock_db, client):
+  old_id = ObjectId.from_datetime(datetime(2020, 1, 1, tzinfo=timezone.utc))
+  kept_id = ObjectId.from_datetime(datetime(2020, 1, 2, tzinfo=timezone.utc))
+  chunks = mock_db["fs.chunks"]
+  chunks.insert_many([{"files_id": old_id, "n": n, "data": b"x"} for n in range(3)])
+  chunks.insert_one({"files_id": ObjectId(), "n": 0, "data": b"x"})  # Being written
+  mock_fs.put(b"kept", _id=kept_id)
+
+  res = client.post("/image/sweep-orphaned-chunks?dry_run=true")
+  assert res.json == {"files": 1, "chunks": 3, "dry_run": True}
+  assert chunks.count_documents({}) == 5
+  res = client.post("/image/sweep-orphaned-chunks")
+  assert res.json == {"files": 1, "chunks": 3}
+  assert chunks.count_documents({"files_id": old_id}) == 0
+  assert chunks.count_documents({}) == 2
+
+
+def test_get_image_read_endpoint_cached(mock_fs, mock_db, mock_data, client):
+  entry = mock_data[0]
+  _id = mock_fs.put(**entry)
+  assert client.get(f"/image/read/{_id}").data == entry["data"]
+  hits = image_cache.stats()["hits"]
+  with patch("imaginate_api.utils.fs.find") as mock_find:
+    res = client.get(f"/image/read/{_id}", headers={"Range": "bytes=1-2"})
+    assert res.data == entry["data"][1:3]
+    mock_find.assert_not_called()
+  assert image_cache.stats()["hits"] == hits + 1
+
+  # Properties only need the metadata, they are looked up without loading the content
+  assert client.get(f"/image/read/{_id}/properties").json["theme"] == entry["theme"]
+  assert image_cache.stats()["hits"] == hits + 1
+
+  with patch("imaginate_api.image.routes.db", mock_db):
+    client.post("/image/update-status", data={"_id": str(_id), "status": "verified"})
+  assert client.get(f"/image/read/{_id}/properties").json["status"] == "verified"
+  client.delete(f"/image/{_id}")
+  assert client.get(f"/image/read/{_id}").status_code == HTTPStatus.NOT_FOUND
+  assert cache.get(f"images:{_id}") is None
+
+
 # Not testing scenarios with exceptions as they have been tested by helper functions:
 # validate_id, search_id
 def test_get_image_read_properties_endpoint(mock_fs, mock_data, client):
@@ -297,6 +678,206 @@ def test_get_image_read_properties_endpoint(mock_fs, mock_data, client):
 #   assert res.status_code == expected
 
 
+def test_get_date_images_endpoint_cached(mock_fs, mock_db, mock_data, client):
+  entry = mock_data[0]
+  _id = mock_fs.put(**entry)
+  mock_db["days"].insert_one({"_id": entry["date"], "images": [_id]})
+  with (
+    patch("imaginate_api.date.routes.db", mock_db),
+    patch(
+      "imaginate_api.date.routes.resolve_day", return_value=entry["date"]
+    ) as mock_resolve,
+  ):
+    res = client.get(f"/date/{entry['date']}/images")
+    assert res.status_code == HTTPStatus.OK
+    assert res.json[0]["data"] == base64.b64encode(entry["data"]).decode("utf-8")
+
+    # Repeated and conditional requests are answered without resolving or rebuilding
+    with patch("imaginate_api.date.routes.build_day_bundle") as mock_build:
+      res = client.get(
+        f"/date/{entry['date']}/images", headers={"If-None-Match": res.get_etag()[0]}
+      )
+      assert res.status_code == HTTPStatus.NOT_MODIFIED
+      mock_build.assert_not_called()
+    mock_resolve.assert_called_once()
+
+
+def test_get_date_images_endpoint_deleted_shared(mock_db, mock_data, client):
+  with client.application.app_context():
+    ids = [
+      store_image(FileStorage(BytesIO(b"shared"), "a.png"), 0, "a", True, "verified")
+      for _ in range(2)
+    ]
+  date = mock_data[0]["date"]
+  mock_db["days"].insert_one({"_id": date, "images": ids})
+  assert client.delete(f"/image/{ids[0]}").status_code == HTTPStatus.OK
+  with (
+    patch("imaginate_api.date.routes.db", mock_db),
+    patch("imaginate_api.date.routes.resolve_day", return_value=date),
+  ):
+    res = client.get(f"/date/{date}/images")
+  assert res.status_code == HTTPStatus.OK
+  assert [image["url"] for image in res.json] == [f"image/read/{ids[1]}"]
+
+
+def test_get_date_images_endpoint_delivery_modes(mock_fs, mock_db, mock_data, client):
+  entry = mock_data[0]
+  _id = mock_fs.put(**entry)
+  mock_db["days"].insert_one({"_id": entry["date"], "images": [_id]})
+  with (
+    patch("imaginate_api.date.routes.db", mock_db),
+    patch("imaginate_api.date.routes.resolve_day", return_value=entry["date"]),
+  ):
+    res = client.get(f"/date/{entry['date']}/images?format=manifest")
+    assert res.status_code == HTTPStatus.OK
+    assert res.json == [
+      build_result(
+        _id,
+        entry["real"],
+        entry["date"],
+        entry["theme"],
+        entry["status"],
+        entry["filename"],
+      )
+    ]
+
+    res = client.get(
+      f"/date/{entry['date']}/images", headers={"Accept": "multipart/mixed"}
+    )
+    assert res.status_code == HTTPStatus.OK
+    assert res.mimetype == "multipart/mixed"
+    assert f"Content-ID: <{_id}>".encode() in res.data
+    assert entry["data"] in res.data
+
+    res = client.get(f"/date/{entry['date']}/images?format=foo")
+    assert res.status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_get_date_images_endpoint_compressed(mock_fs, mock_db, mock_data, client):
+  entry = {**mock_data[0], "data": b"data" * 1000}
+  _id = mock_fs.put(**entry)
+  mock_db["days"].insert_one({"_id": entry["date"], "images": [_id]})
+  with (
+    patch("imaginate_api.date.routes.db", mock_db),
+    patch("imaginate_api.date.routes.resolve_day", return_value=entry["date"]),
+  ):
+    res = client.get(f"/date/{entry['date']}/images")
+    assert "Content-Encoding" not in res.headers
+    body = res.data
+
+    headers = {"Accept-Encoding": "gzip"}
+    res = client.get(f"/date/{entry['date']}/images", headers=headers)
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in res.headers["Vary"]
+    assert gzip.decompress(res.data) == body
+
+    # The compressed body is cached, along with its own validator
+    headers["If-None-Match"] = res.get_etag()[0]
+    with patch("imaginate_api.compression.compress_gzip") as mock_compress:
+      res = client.get(f"/date/{entry['date']}/images", headers=headers)
+      assert res.status_code == HTTPStatus.NOT_MODIFIED
+      mock_compress.assert_not_called()
+
+
+def test_response_compression(mock_fs, mock_db, mock_data, client):
+  for entry in mock_data:
+    mock_fs.put(**{**entry, "theme": "sample" * 100})
+  _id = mock_fs.put(**mock_data[0])
+  with patch("imaginate_api.image.routes.db", mock_db):
+    res = client.get("/image/all-images", headers={"Accept-Encoding": "gzip;q=0.5"})
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(res.data))[0]["theme"] == "sample" * 100
+
+    res = client.get(
+      f"/image/read/{_id}/properties", headers={"Accept-Encoding": "gzip"}
+    )
+    assert "Content-Encoding" not in res.headers  # Below the size threshold
+
+    res = client.get("/image/all-images", headers={"Accept-Encoding": "gzip;q=0"})
+    assert "Content-Encoding" not in res.headers
+
+
+def test_bundle_cache_invalidation(tmp_path):
+  _id = ObjectId()
+  builder = MagicMock(side_effect=lambda: Bundle(b"[]", image_ids=[_id]))
+  bundle = bundles.get(0, builder)
+  cached = bundles.get(0, builder)
+  assert builder.call_count == 1
+  assert (cached.body, cached.image_ids, cached.etag) == (b"[]", (_id,), bundle.etag)
+  assert cached.last_modified == bundle.last_modified
+
+  bundles.invalidate()
+  bundles.get(0, builder)
+  assert builder.call_count == 2
+
+  # Workers sharing a backend see each other's bundles and invalidations
+  worker_a = BundleCache(DiskCache(tmp_path, 1 << 20))
+  worker_b = BundleCache(DiskCache(tmp_path, 1 << 20))
+  worker_a.get(0, builder)
+  worker_b.get(0, builder)
+  assert builder.call_count == 3
+  worker_b.invalidate()
+  worker_a.get(0, builder)
+  assert builder.call_count == 4
+
+
+def test_cache_shared_by_workers(tmp_path):
+  config = Struct(
+    CACHE_BACKEND=None,
+    SERVER_WORKERS=2,
+    CACHE_DIR=str(tmp_path),
+    CACHE_MAX_BYTES=1 << 20,
+  )
+  assert isinstance(create_cache(config), DiskCache)
+  builder = MagicMock(return_value=Bundle(b"[]"))
+  bundle_cache = BundleCache(create_cache(config))
+  bundle_cache.get(0, builder)
+
+  # Invalidated by another worker process
+  script = (
+    "from imaginate_api.cache import DiskCache\n"
+    "from imaginate_api.date.bundle import BundleCache\n"
+    f"BundleCache(DiskCache({str(tmp_path)!r}, 1 << 20)).invalidate()\n"
+  )
+  subprocess.run([sys.executable, "-c", script], check=True, timeout=30)
+  bundle_cache.get(0, builder)
+  assert builder.call_count == 2
+
+
+def test_local_cache():
+  backend = LocalCache(max_bytes=10)
+  backend.set("a", b"12345")
+  backend.set("b", b"12345")
+  backend.get("a")
+  backend.set("c", b"12345")  # Evicts "b", the least recently used
+  assert [backend.get(key) for key in "abc"] == [b"12345", None, b"12345"]
+  assert backend.stats()["evictions"] == 1
+
+  backend.set("d", b"1", ttl=-1)
+  assert backend.get("d") is None
+  assert backend.incr("counter") == 1 and backend.get_counter("counter") == 1
+
+
+def test_disk_cache(tmp_path):
+  backend = DiskCache(tmp_path, max_bytes=100)
+  other = DiskCache(tmp_path, max_bytes=100)
+  backend.set("a", b"value")
+  assert other.get("a") == b"value"
+  other.delete("a")
+  assert backend.get("a") is None
+
+  backend.set("b", b"value", ttl=-1)
+  assert other.get("b") is None
+  assert [backend.incr("counter"), other.incr("counter")] == [1, 2]
+  assert backend.get_counter("counter") == 2
+
+  for key in range(20):
+    backend.set(str(key), b"x" * 20)
+  backend.prune()
+  assert backend.stats()["bytes"] <= 100
+  assert backend.get("19") == b"x" * 20
+
+
 # Tested differently since the endpoint involves sorting
 def test_get_date_latest_endpoint_success(mock_data, client):
   with patch("imaginate_api.date.routes.fs.find") as mock_find:
@@ -317,6 +898,74 @@ def test_get_date_latest_endpoint_exception(client):
     assert res.status_code == HTTPStatus.NOT_FOUND
 
 
+def test_get_all_images_endpoint(mock_fs, mock_db, mock_data, client):
+  ids = [mock_fs.put(**entry) for entry in mock_data]
+  with patch("imaginate_api.image.routes.db", mock_db):
+    res = client.get("/image/all-images?limit=3")
+    assert res.status_code == HTTPStatus.OK
+    assert [image["url"] for image in res.json] == [f"image/read/{_id}" for _id in ids[:3]]
+    assert "data" not in res.json[0]
+
+    res = client.get(f"/image/all-images?limit=3&after={res.headers['X-Next-Cursor']}")
+    assert [image["url"] for image in res.json] == [f"image/read/{_id}" for _id in ids[3:]]
+    assert "X-Next-Cursor" not in res.headers
+
+    res = client.get("/image/all-images?date_from=1&date_to=2")
+    assert [image["date"] for image in res.json] == [
+      mock_data[1]["date"],
+      mock_data[2]["date"],
+    ]
+
+    res = client.get("/image/all-images?format=ndjson&theme=sample")
+    assert res.mimetype == "application/x-ndjson"
+    assert len(res.data.splitlines()) == len(mock_data)
+
+    res = client.get("/image/all-images?limit=0")
+    assert res.status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_verification_queue_endpoints(mock_fs, mock_db, mock_data, client):
+  ids = [mock_fs.put(**entry) for entry in mock_data]
+  with (
+    patch("imaginate_api.image.verification.db", mock_db),
+    patch("imaginate_api.image.routes.db", mock_db),
+  ):
+    res = client.post("/image/verification-queue", json={"limit": 3, "reviewer": "a"})
+    assert res.status_code == HTTPStatus.OK
+    claim = res.json["claim"]
+    assert [image["url"] for image in res.json["images"]] == [
+      f"image/read/{_id}" for _id in ids[:3]
+    ]
+    assert res.json["images"][0]["thumbnail_url"] == f"image/read/{ids[0]}?size=320"
+
+    # Claimed images are not handed to another reviewer
+    res = client.post("/image/verification-queue", json={"limit": 3, "reviewer": "b"})
+    assert [image["url"] for image in res.json["images"]] == [
+      f"image/read/{_id}" for _id in ids[3:]
+    ]
+
+    updates = [
+      {"id": str(ids[0]), "status": "verified"},
+      {"id": str(ids[1]), "status": "rejected"},
+      {"id": str(ids[3]), "status": "verified"},  # Claimed by the other reviewer
+    ]
+    files = mock_db["fs.files"]
+    with patch.object(files, "bulk_write", wraps=files.bulk_write) as mock_bulk_write:
+      res = client.post(
+        "/image/update-status-bulk", json={"claim": claim, "updates": updates}
+      )
+    assert res.json == {"matched": 2, "modified": 2}
+    mock_bulk_write.assert_called_once()
+    assert mock_db["fs.files"].find_one({"_id": ids[1]})["status"] == "rejected"
+    assert "claim_token" not in mock_db["fs.files"].find_one({"_id": ids[0]})
+
+    updates = [{"id": str(ids[0]), "status": "foo"}]
+    res = client.post("/image/update-status-bulk", json={"updates": updates})
+    assert res.status_code == HTTPStatus.BAD_REQUEST
+    res = client.post("/image/verification-queue", json={"limit": 0})
+    assert res.status_code == HTTPStatus.BAD_REQUEST
+
+
 def test_delete_image_endpoint(mock_fs, mock_data, client):
   for entry in mock_data:
     _id = mock_fs.put(**entry)
@@ -341,3 +990,250 @@ def test_delete_image_success(client, mock_fs, mock_data):
     response_data = res.get_json()
     res_id = response_data.get("url").split("/")[-1]
     assert res_id == str(_id)
+
+
+def test_latest_date_cache(mock_fs, mock_data, client):
+  with patch("imaginate_api.date.routes.fs.find") as mock_find:
+    mock_find.return_value.sort.return_value.limit.return_value = iter(
+      [Struct(**mock_data[0])]
+    )
+    assert client.get("date/latest").json == {"date": mock_data[0]["date"]}
+    assert client.get("date/latest").json == {"date": mock_data[0]["date"]}
+    mock_find.assert_called_once()
+
+    # Uploads of earlier dates keep the cached value, later dates need a new lookup
+    with client.application.app_context():
+      latest.bump(mock_data[0]["date"] - 1)
+    assert client.get("date/latest").json == {"date": mock_data[0]["date"]}
+    mock_find.assert_called_once()
+    mock_find.return_value.sort.return_value.limit.return_value = iter(
+      [Struct(**mock_data[1])]
+    )
+    with client.application.app_context():
+      latest.bump(mock_data[1]["date"])
+    assert client.get("date/latest").json == {"date": mock_data[1]["date"]}
+    assert mock_find.call_count == 2
+
+
+
+def test_latest_date_cache_upload_during_lookup(mock_data, client):
+  # The upload lands while a lookup is in flight, after it read the previous latest date
+  def find_before_upload(*args, **kwargs):
+    latest.bump(mock_data[1]["date"])
+    return mock_find.return_value
+
+  with patch("imaginate_api.date.routes.fs.find") as mock_find:
+    mock_find.side_effect = find_before_upload
+    mock_find.return_value.sort.return_value.limit.return_value = iter(
+      [Struct(**mock_data[0])]
+    )
+    assert client.get("date/latest").json == {"date": mock_data[0]["date"]}
+
+    mock_find.side_effect = None
+    mock_find.return_value.sort.return_value.limit.return_value = iter(
+      [Struct(**mock_data[1])]
+    )
+    assert client.get("date/latest").json == {"date": mock_data[1]["date"]}
+    assert mock_find.call_count == 2
+
+def test_get_plan_stages():
+  plan = {
+    "queryPlan": {
+      "stage": "LIMIT",
+      "inputStage": {
+        "stage": "OR",
+        "inputStages": [{"stage": "IXSCAN"}, {"stage": "COLLSCAN"}],
+      },
+    }
+  }
+  assert get_plan_stages(plan) == ["LIMIT", "OR", "IXSCAN", "COLLSCAN"]
+
+
+def test_ensure_indexes(mock_db):
+  ensure_indexes(mock_db)
+  ensure_indexes(mock_db)  # Idempotent
+  for collection_name, indexes in INDEXES.items():
+    index_names = mock_db[collection_name].index_information()
+    assert all(index.document["name"] in index_names for index in indexes)
+
+
+def test_ensure_indexes_users(mock_db):
+  collection = mock_db["users"]
+  collection.create_index("email", name="email")  # Declared before it was unique
+  # Duplicated by concurrent first logins, the newer user is the one still active
+  collection.insert_one({"email": "a@example.com", "active": False})
+  active = {"email": "a@example.com", "google_id": "1", "active": True}
+  active_id = collection.insert_one(active).inserted_id
+
+  # The unique index cannot replace the previous one while values are duplicated
+  ensure_indexes(mock_db)
+  index_names = collection.index_information()
+  assert "email" in index_names and "email_unique" not in index_names
+
+  assert merge_duplicate_users(collection, dry_run=True) == 1
+  assert collection.count_documents({}) == 2
+  assert merge_duplicate_users(collection) == 1
+  assert list(collection.find({}, {"_id": 1})) == [{"_id": active_id}]
+
+  ensure_indexes(mock_db)
+  index_names = collection.index_information()
+  assert "email_unique" in index_names and "email" not in index_names
+
+
+def test_mongo_connection_lazy(mock_mongo_client):
+  mock_mongo_client["imaginate_dev"]["sample"].insert_one({})
+  with patch(
+    "imaginate_api.extensions.MongoClient", return_value=mock_mongo_client
+  ) as mock_client:
+    connection = MongoConnection("mongodb://localhost", "imaginate_dev")
+    mock_client.assert_not_called()
+    assert connection.db.name == "imaginate_dev"
+    assert connection.fs is connection.fs
+    mock_client.assert_called_once()
+
+    # A forked process creates its own client
+    with patch("os.getpid", return_value=-1):
+      assert connection.db.name == "imaginate_dev"
+    assert mock_client.call_count == 2
+
+
+# Helper function to get the samples exposed on GET /metrics, as name and labels -> value
+def get_metric_samples(client):
+  lines = client.get("/metrics").get_data(as_text=True).splitlines()
+  return dict(line.rsplit(" ", 1) for line in lines if not line.startswith("#"))
+
+
+def test_metrics_endpoint(mock_fs, mock_data, client):
+  _id = mock_fs.put(**mock_data[0])
+  labels = 'blueprint="image",endpoint="image.read"'
+  count = f'http_request_duration_seconds_count{{{labels},method="GET",status="200"}}'
+  size = f'http_response_size_bytes_bucket{{{labels},le="256"}}'
+  before = get_metric_samples(client)
+  assert client.get(f"/image/read/{_id}").status_code == HTTPStatus.OK
+  after = get_metric_samples(client)
+  assert float(after[count]) == float(before.get(count, 0)) + 1
+  assert float(after[size]) == float(before.get(size, 0)) + 1
+  assert "imaginate_image_cache_misses" in after
+
+  # MongoDB commands are timed through pymongo's command monitoring, which mongomock does not emit
+  with client.application.test_request_context():
+    metrics.start_request()
+    event = MagicMock(connection_id=1, request_id=1, command_name="find")
+    event.command = {"find": "fs.files", "filter": {}}
+    command_timer.started(event)
+    event.duration_micros = 2000
+    command_timer.succeeded(event)
+    assert g.mongodb_commands == 1 and g.mongodb_duration == 0.002
+  labels = 'collection="fs.files",command="find"'
+  samples = get_metric_samples(client)
+  assert f"mongodb_command_duration_seconds_count{{{labels}}}" in samples
+
+
+def test_request_profiling(mock_fs, mock_data, tmp_path):
+  config = {
+    "PROFILING_ENABLED": True,
+    "PROFILING_TOKEN": "secret",
+    "PROFILING_DIR": str(tmp_path),
+    "PROFILING_MAX_FILES": 2,
+  }
+  with patch.multiple(Config, **config):
+    client = create_app().test_client()
+  _id = mock_fs.put(**mock_data[0])
+
+  assert "X-Profile-Id" not in client.get(f"/image/read/{_id}").headers
+  res = client.get(f"/image/read/{_id}", headers={"X-Profile": "secret"})
+  assert res.data == mock_data[0]["data"]
+  name = res.headers["X-Profile-Id"]
+  assert client.get("/profiles").status_code == HTTPStatus.FORBIDDEN
+  profiles = client.get("/profiles", headers={"X-Profile": "secret"}).json
+  assert [profile["name"] for profile in profiles] == [name]
+  res = client.get(f"/profiles/{name}.txt", headers={"X-Profile": "secret"})
+  assert res.data.startswith(f"GET /image/read/{_id}".encode())
+  assert b"Top allocating lines" in res.data
+
+  for _ in range(3):
+    client.get("/date/latest", headers={"X-Profile": "secret"})
+  assert len(list(tmp_path.glob("*.prof"))) == 2
+
+
+def test_user_cache(mock_db):
+  collection = mock_db["users"]
+  user_id = collection.insert_one(
+    {"email": "player@example.com", "authenticated": True, "active": True}
+  ).inserted_id
+  users.clear()
+  with (
+    patch("imaginate_api.schemas.user_info.COLLECTION", collection),
+    patch.object(collection, "find_one", wraps=collection.find_one) as find_one,
+  ):
+    user = load_user(str(user_id))
+    assert load_user(str(user_id)) is user  # Second load is served from the process
+    users.clear()
+    assert load_user(str(user_id)).email == "player@example.com"  # From the backend
+    assert find_one.call_count == 1
+    assert not hasattr(user, "__dict__")
+
+    user.deactivate_user()
+    assert not load_user(str(user_id)).is_active
+    assert find_one.call_count == 2
+    assert load_user(str(ObjectId())) is None
+
+
+def test_find_or_create_user(mock_db):
+  collection = mock_db["users"]
+  ensure_indexes(mock_db)
+  existing_id = collection.insert_one(
+    {"email": "player@example.com", "authenticated": False, "active": True}
+  ).inserted_id
+  with patch("imaginate_api.schemas.user_info.COLLECTION", collection):
+    # Linked to the user with the same email
+    user = User.find_or_create_user(
+      {"email": "player@example.com", "id": "1"}, "google"
+    )
+    assert user.id == existing_id and user.is_authenticated
+    assert collection.find_one({"_id": existing_id})["google_id"] == "1"
+
+    # Created on its first login, found by its provider ID afterwards
+    user = User.find_or_create_user({"email": "new@example.com", "id": "2"}, "google")
+    assert user.is_active and user.is_authenticated
+    again = User.find_or_create_user({"email": "new@example.com", "id": "2"}, "google")
+    assert again.id == user.id
+    assert collection.count_documents({}) == 2
+    assert load_user(str(user.id)).email == "new@example.com"
+
+    # The provider ID wins over an email belonging to another user
+    other = {"email": "other@example.com", "google_id": "3", "active": True}
+    collection.insert_one(other)
+    user = User.find_or_create_user({"email": "new@example.com", "id": "3"}, "google")
+    assert user.email == "other@example.com" and user.is_authenticated
+
+    # Deactivated users are not authenticated
+    deactivated = {"email": "gone@example.com", "active": False}
+    deactivated_id = collection.insert_one(deactivated).inserted_id
+    user = User.find_or_create_user({"email": "gone@example.com", "id": "4"}, "google")
+    assert user.id == deactivated_id
+    assert not user.is_active and not user.is_authenticated
+    assert collection.count_documents({"email": "gone@example.com"}) == 1
+
+
+def test_find_or_create_user_race(mock_db):
+  collection = mock_db["users"]
+  ensure_indexes(mock_db)
+  find_one_and_update = collection.find_one_and_update
+
+  # A concurrent first login of the same user wins the upsert
+  def lose_race(query, update, **options):
+    if options.get("upsert"):
+      collection.insert_one(
+        {"email": "new@example.com", "google_id": "1", "active": True}
+      )
+      raise DuplicateKeyError("E11000 duplicate key error")
+    return find_one_and_update(query, update, **options)
+
+  with (
+    patch("imaginate_api.schemas.user_info.COLLECTION", collection),
+    patch.object(collection, "find_one_and_update", side_effect=lose_race),
+  ):
+    user = User.find_or_create_user({"email": "new@example.com", "id": "1"}, "google")
+  assert user.is_authenticated
+  assert collection.count_documents({}) == 1